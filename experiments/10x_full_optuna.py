@@ -37,7 +37,7 @@ if args.filter_non_binder:
 train, val = stratified_group_shuffle_split(adata.obs, stratify_col='binding_name', group_col='clonotype',
                                               val_split=0.2, random_seed=random_seed)
 adata.obs['set'] = 'train'
-adata.obs.loc[val.index, 'set'] = 'val'
+adata.obs.loc[adata.obs_names[val], 'set'] = 'val'
 
 
 params_experiment = {
@@ -38,12 +38,12 @@ random_seed = args.split
 
 adata.obs['group_col'] = [seq[1:-1] for seq in adata.obs['IR_VDJ_1_cdr3']]
 train_val, test = group_shuffle_split(adata, group_col='group_col', val_split=0.20, random_seed=random_seed)
-train, val = group_shuffle_split(train_val, group_col='group_col', val_split=0.25, random_seed=random_seed)
+train, val = group_shuffle_split(adata[train_val], group_col='group_col', val_split=0.25, random_seed=random_seed)
 
 
 adata.obs['set'] = 'train'
-adata.obs.loc[val.obs.index, 'set'] = 'val'
-adata.obs.loc[test.obs.index, 'set'] = 'test'
+adata.obs.loc[adata.obs_names[train_val[val]], 'set'] = 'val'
+adata.obs.loc[adata.obs_names[test], 'set'] = 'test'
 adata = adata[adata.obs['set'].isin(['train', 'val'])]
 
 
@@ -31,11 +31,11 @@ adata.obs['Reactivity'] = (adata.obs['Specificity'] != 'Probe_Negative').astype(
 # subsample to get statistics
 random_seed = args.split
 train_val, test = group_shuffle_split(adata, group_col='clonotype', val_split=0.20, random_seed=random_seed)
-train, val = group_shuffle_split(train_val, group_col='clonotype', val_split=0.25, random_seed=random_seed)
+train, val = group_shuffle_split(adata[train_val], group_col='clonotype', val_split=0.25, random_seed=random_seed)
 
 adata.obs['set'] = 'train'
-adata.obs.loc[val.obs.index, 'set'] = 'val'
-adata.obs.loc[test.obs.index, 'set'] = 'test'
+adata.obs.loc[adata.obs_names[train_val[val]], 'set'] = 'val'
+adata.obs.loc[adata.obs_names[test], 'set'] = 'test'
 adata = adata[adata.obs['set'].isin(['train', 'val'])]
 
 params_experiment = {
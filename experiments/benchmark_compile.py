@@ -0,0 +1,110 @@
+"""
+python -u benchmark_compile.py --model poe moe --dataset 10x --n_epochs 3
+Compares the training epochs and get_latent of eager models with params_architecture['compile'], the first epoch and
+the first get_latent include the compilation and are reported separately.
+"""
+import sys
+sys.path.append('..')
+
+import tcr_embedding.utils_training as utils
+from tcr_embedding.utils_preprocessing import group_shuffle_split
+
+import time
+import tempfile
+import argparse
+import numpy as np
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, nargs='+', default=['poe', 'moe', 'separate', 'rna'])
+parser.add_argument('--dataset', type=str, default='10x')
+parser.add_argument('--n_cells', type=int, default=None)
+parser.add_argument('--n_epochs', type=int, default=3)
+parser.add_argument('--backend', type=str, default='inductor')
+parser.add_argument('--precision', type=str, default='float32')
+parser.add_argument('--variable_length', action='store_true')
+args = parser.parse_args()
+
+
+def get_params(model_name):
+    params = {
+        'batch_size': 512,
+        'learning_rate': 1e-4,
+        'loss_weights': [1.0, 0.01, 1e-6],
+        'precision': args.precision,
+        'joint': {
+            'activation': 'leakyrelu',
+            'batch_norm': True,
+            'dropout': 0.1,
+            'hdim': 300,
+            'losses': ['MSE', 'CE'],
+            'num_layers': 2,
+            'shared_hidden': [200] * 2,
+            'zdim': 20,
+            'c_embedding_dim': 20,
+        },
+        'rna': {
+            'activation': 'leakyrelu',
+            'batch_norm': True,
+            'dropout': 0.1,
+            'gene_hidden': [1000],
+            'num_layers': 1,
+            'output_activation': 'linear'
+        },
+        'tcr': {
+            'embedding_size': 32,
+            'num_heads': 4,
+            'forward_expansion': 4,
+            'encoding_layers': 2,
+            'decoding_layers': 2,
+            'dropout': 0.1,
+            'variable_length': args.variable_length,
+        },
+    }
+    if model_name == 'rna':
+        del params['tcr']
+    return params
+
+
+def run(model_name, compile_backend, save_path):
+    utils.fix_seeds(42)
+    params = get_params(model_name)
+    params['compile'] = compile_backend
+    balanced_sampling = None if model_name == 'rna' else 'clonotype'
+    model = utils.select_model_by_name(model_name)(adata, params, balanced_sampling, ['clonotype'])
+
+    times = {}
+    t = time.time()
+    model.train(1, params['batch_size'], params['learning_rate'], params['loss_weights'], kl_annealing_epochs=1,
+                save_path=save_path)
+    times['first epoch'] = time.time() - t
+    t = time.time()
+    model.train(args.n_epochs, params['batch_size'], params['learning_rate'], params['loss_weights'],
+                kl_annealing_epochs=1, save_path=save_path)
+    times['epoch'] = (time.time() - t) / args.n_epochs
+
+    t = time.time()
+    model.get_latent(adata, ['clonotype'])
+    times['first get_latent'] = time.time() - t
+    t = time.time()
+    latent = model.get_latent(adata, ['clonotype'])
+    times['get_latent'] = time.time() - t
+    return times, np.asarray(latent.X)
+
+
+adata = utils.load_data(args.dataset)
+if args.n_cells is not None and args.n_cells < adata.n_obs:
+    adata = adata[np.random.default_rng(42).choice(adata.n_obs, args.n_cells, replace=False)].copy()
+train, val = group_shuffle_split(adata, group_col='clonotype', val_split=0.20, random_seed=42)
+adata.obs['set'] = 'train'
+adata.obs.loc[adata.obs_names[val], 'set'] = 'val'
+
+with tempfile.TemporaryDirectory() as save_path:
+    for model_name in args.model:
+        times_eager, latent_eager = run(model_name, False, save_path)
+        times_compiled, latent_compiled = run(model_name, args.backend, save_path)
+        for key in times_eager:
+            print(f'{model_name} {key}: eager {times_eager[key]:.2f}s, compiled {times_compiled[key]:.2f}s, '
+                  f'speedup {times_eager[key] / times_compiled[key]:.2f}x')
+        # both runs use the same seeds, so the latents only differ by the numerics of the generated kernels
+        print(f'{model_name} max abs difference of the latents: {np.abs(latent_eager - latent_compiled).max():.2e}')
@@ -53,7 +53,7 @@ for patients in holdout_patients.values():
 
 train, val = group_shuffle_split(adata, group_col='clonotype', val_split=0.2, random_seed=random_seed)
 adata.obs['set'] = 'train'
-adata.obs.loc[val.obs.index, 'set'] = 'val'
+adata.obs.loc[adata.obs_names[val], 'set'] = 'val'
 
 print(len(adata))
 
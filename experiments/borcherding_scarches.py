@@ -8,7 +8,6 @@ import sys
 sys.path.append('..')
 
 import numpy as np
-import torch
 from tcr_embedding.models.model_selection import run_model_selection
 import tcr_embedding.utils_training as utils
 from tcr_embedding.utils_preprocessing import group_shuffle_split
@@ -47,12 +46,13 @@ elif args.set == 2:
                        ]
 
 adata = adata[~adata.obs[args.conditional].isin(holdout_cohorts)].copy()
-adata.obsm[args.conditional] = torch.nn.functional.one_hot(torch.tensor(adata.obs[args.conditional].factorize()[0])).numpy()
+# the conditional is read as label codes from the categorical column, unused holdout cohorts are dropped
+adata.obs[args.conditional] = adata.obs[args.conditional].astype(str).astype('category')
 
 
 train, val = group_shuffle_split(adata, group_col='clonotype', val_split=0.2, random_seed=random_seed)
 adata.obs['set'] = 'train'
-adata.obs.loc[val.obs.index, 'set'] = 'val'
+adata.obs.loc[adata.obs_names[val], 'set'] = 'val'
 adata = adata[adata.obs['set'].isin(['train', 'val'])]
 
 if args.wo_tcr_genes == 'True':
@@ -30,7 +30,7 @@ adata = utils.load_data('haniffa_bcr')
 random_seed = 42
 train, val = group_shuffle_split(adata, group_col='clonotype', val_split=0.20, random_seed=random_seed)
 adata.obs['set'] = 'train'
-adata.obs.loc[val.obs.index, 'set'] = 'val'
+adata.obs.loc[adata.obs_names[val], 'set'] = 'val'
 adata = adata[adata.obs['set'].isin(['train', 'val'])]
 
 
@@ -35,7 +35,7 @@ if args.patient is not None:
 random_seed = 42
 train, val = group_shuffle_split(adata, group_col='clonotype', val_split=0.25, random_seed=random_seed)
 adata.obs['set'] = 'train'
-adata.obs.loc[val.obs.index, 'set'] = 'val'
+adata.obs.loc[adata.obs_names[val], 'set'] = 'val'
 adata.obs['set'] = adata.obs['set'].astype('category')
 
 
@@ -0,0 +1,240 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import torch
+from collections.abc import Mapping
+from scipy import sparse
+
+from tcr_embedding.dataloader.TensorCache import save_matrix, load_matrix, STORAGE_DTYPES
+
+
+# increase when the layout of the bundle changes
+BUNDLE_VERSION = 1
+
+
+def export_bundle(adata, path, obs_columns=None, obsm_keys=None, layers=None, rna_dtype='float32'):
+    """
+    Write the parts of a preprocessed adata that are needed for training into a directory of npy files with a JSON
+    manifest. Categorical and string columns of obs are stored as integer codes. Training runs open the directory as
+    TrainingBundle, which memory-maps the arrays instead of parsing an h5ad.
+    :param adata: adata after preprocessing, e.g. with encode_tcr and the 'set' column
+    :param path: str, directory of the bundle, must not exist yet
+    :param obs_columns: None or list of str, columns of adata.obs to store, by default all
+    :param obsm_keys: None or list of str, keys of adata.obsm to store, by default all
+    :param layers: None or list of str, layers to store, e.g. raw counts for params_loader['counts_layer']
+    :param rna_dtype: str, storage dtype of X and the layers, 'float32', 'float16' or 'bfloat16', models with the same
+                      params_loader['rna_dtype'] use the files without converting them, note that float16 only holds
+                      integer counts up to 2048 exactly
+    """
+    if os.path.exists(path):
+        raise ValueError(f'{path} already exists, please choose a new directory for the bundle.')
+    if rna_dtype not in STORAGE_DTYPES:
+        raise ValueError(f'Unknown rna_dtype {rna_dtype}, please choose one of {STORAGE_DTYPES}.')
+    obs_columns = list(adata.obs.columns) if obs_columns is None else list(obs_columns)
+    obsm_keys = list(adata.obsm.keys()) if obsm_keys is None else list(obsm_keys)
+    layers = [] if layers is None else list(layers)
+
+    path_tmp = f'{path}.tmp{os.getpid()}'
+    os.makedirs(path_tmp)
+    manifest = {'version': BUNDLE_VERSION, 'n_obs': int(adata.n_obs), 'var_names': adata.var_names.tolist(),
+                'uns': {}, 'obs': {}, 'obsm': {}, 'layers': {}}
+    if 'aa_to_id' in adata.uns:
+        manifest['uns']['aa_to_id'] = {aa: int(id_) for aa, id_ in adata.uns['aa_to_id'].items()}
+    np.save(os.path.join(path_tmp, 'obs_names.npy'), adata.obs_names.to_numpy(dtype=str))
+
+    for i, column in enumerate(obs_columns):
+        values = adata.obs[column]
+        # the files are numbered, as column names may contain any character
+        entry = {'file': f'obs_{i}'}
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            entry['categories'] = None
+            array = values.to_numpy()
+        else:
+            values = values.astype('category')
+            entry['categories'] = values.cat.categories.tolist()
+            array = values.cat.codes.to_numpy().astype(np.int32)
+        np.save(os.path.join(path_tmp, f'{entry["file"]}.npy'), array)
+        manifest['obs'][column] = entry
+
+    for i, key in enumerate(obsm_keys):
+        array = adata.obsm[key]
+        array = array.toarray() if sparse.issparse(array) else np.asarray(array)
+        if array.dtype == object:
+            raise ValueError(f'adata.obsm["{key}"] is not numeric, please exclude it via obsm_keys.')
+        np.save(os.path.join(path_tmp, f'obsm_{i}.npy'), array)
+        manifest['obsm'][key] = {'file': f'obsm_{i}'}
+
+    manifest['X'] = save_matrix(path_tmp, 'X', adata.X, rna_dtype)
+    for i, layer in enumerate(layers):
+        manifest['layers'][layer] = {'file': f'layer_{i}',
+                                     **save_matrix(path_tmp, f'layer_{i}', adata.layers[layer], rna_dtype)}
+
+    with open(os.path.join(path_tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path_tmp, path)
+
+
+class TrainingBundle:
+    def __init__(self, path, positions=None, manifest=None):
+        """
+        Training data written by export_bundle, used in place of an adata by the models and load_model
+        Opening a bundle only reads its manifest. X, layers and obsm are memory-mapped and read by
+        DataLoader.encode_tensors like the ones of an adata. obs is assembled from the stored codes when it is
+        first accessed.
+        :param path: str, directory of the bundle
+        :param positions: None or np.array, positions of the cells of a subset, see __getitem__
+        :param manifest: None or dict, the already read manifest
+        """
+        self.path = path
+        if manifest is None:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                manifest = json.load(f)
+        if manifest['version'] != BUNDLE_VERSION:
+            raise ValueError(f'The bundle {path} has version {manifest["version"]}, please export it again.')
+        self.manifest = manifest
+        self.positions = positions
+        self.uns = manifest['uns']
+        self.obsm = BundleObsm(self)
+        self.layers = BundleLayers(self)
+        self._obs = None
+
+    # a bundle is never backed, subsets are views on the same files
+    isbacked = False
+
+    @property
+    def is_view(self):
+        return self.positions is not None
+
+    @property
+    def n_obs(self):
+        return self.manifest['n_obs'] if self.positions is None else len(self.positions)
+
+    @property
+    def n_vars(self):
+        return len(self.manifest['var_names'])
+
+    @property
+    def shape(self):
+        return self.n_obs, self.n_vars
+
+    @property
+    def var_names(self):
+        return pd.Index(self.manifest['var_names'])
+
+    @property
+    def obs_names(self):
+        return self.obs.index
+
+    def __len__(self):
+        return self.n_obs
+
+    def __getitem__(self, index):
+        """
+        Subset the cells, the subset shares the files with this bundle
+        :param index: boolean mask or integer positions of the cells
+        :return: TrainingBundle
+        """
+        positions = np.arange(self.n_obs)[np.asarray(index)]
+        if self.positions is not None:
+            positions = self.positions[positions]
+        return TrainingBundle(self.path, positions, self.manifest)
+
+    def load(self, name):
+        # copy-on-write, so torch can wrap the arrays without copying them
+        array = np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='c')
+        return array if self.positions is None else array[self.positions]
+
+    @property
+    def obs(self):
+        if self._obs is None:
+            columns = {}
+            for column, entry in self.manifest['obs'].items():
+                values = self.load(entry['file'])
+                if entry['categories'] is not None:
+                    values = pd.Categorical.from_codes(values, categories=entry['categories'])
+                columns[column] = values
+            self._obs = pd.DataFrame(columns, index=pd.Index(self.load('obs_names')))
+        return self._obs
+
+    @property
+    def X(self):
+        return self.get_matrix()
+
+    def get_matrix(self, layer=None, sparse_format='rna_data'):
+        """
+        Gene expression stored in the bundle
+        :param layer: None or str, None for X or the name of an exported layer
+        :param sparse_format: str, see TensorCache.load_matrix, subsets always return a csr_matrix
+        :return: None, np.array, torch.Tensor (dense bfloat16), SparseRnaData or scipy csr_matrix
+        """
+        if layer is None:
+            name, info = 'X', self.manifest['X']
+        elif layer in self.manifest['layers']:
+            info = self.manifest['layers'][layer]
+            name = info['file']
+        else:
+            raise KeyError(f'The bundle {self.path} does not contain the layer {layer}.')
+        if self.positions is None:
+            return load_matrix(self.path, name, info, sparse_format)
+        # subsets, e.g. the val set during evaluation, read their rows into memory
+        return load_matrix(self.path, name, info, sparse_format='csr')[self.positions]
+
+    def get_library_size(self, layer=None):
+        """
+        :param layer: None or str, see get_matrix
+        :return: np.array of float32, total counts of each cell
+        """
+        matrix = self.get_matrix(layer, sparse_format='csr')
+        if matrix is None:
+            raise ValueError(f'The bundle {self.path} does not contain gene expression.')
+        if torch.is_tensor(matrix):
+            return matrix.sum(dim=1, dtype=torch.float32).numpy()
+        # 16 bit values are summed up in float32
+        return np.asarray(matrix.sum(axis=1, dtype=np.float32)).ravel()
+
+
+class BundleObsm(Mapping):
+    def __init__(self, bundle):
+        """
+        obsm of a bundle, arrays are memory-mapped when they are accessed
+        :param bundle: TrainingBundle
+        """
+        self.bundle = bundle
+
+    def __getitem__(self, key):
+        if key not in self.bundle.manifest['obsm']:
+            raise KeyError(key)
+        return self.bundle.load(self.bundle.manifest['obsm'][key]['file'])
+
+    def __contains__(self, key):
+        return key in self.bundle.manifest['obsm']
+
+    def __iter__(self):
+        return iter(self.bundle.manifest['obsm'])
+
+    def __len__(self):
+        return len(self.bundle.manifest['obsm'])
+
+
+class BundleLayers(Mapping):
+    def __init__(self, bundle):
+        """
+        Exported layers of a bundle, see TrainingBundle.get_matrix
+        :param bundle: TrainingBundle
+        """
+        self.bundle = bundle
+
+    def __getitem__(self, key):
+        if key not in self.bundle.manifest['layers']:
+            raise KeyError(key)
+        return self.bundle.get_matrix(key)
+
+    def __contains__(self, key):
+        return key in self.bundle.manifest['layers']
+
+    def __iter__(self):
+        return iter(self.bundle.manifest['layers'])
+
+    def __len__(self):
+        return len(self.bundle.manifest['layers'])
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from collections.abc import Mapping
+
+
+class AnnDataCollection:
+    def __init__(self, adatas, keys=None, cohort_key='cohort'):
+        """
+        Several adatas, e.g. h5ad files of different cohorts opened with backed='r', used as one logical dataset
+        Only obs and the small obsm arrays are concatenated, the gene expression stays with each adata and is
+        gathered per batch, see ConcatRnaData. Cells keep the order of the adatas.
+        :param adatas: list of adatas with the same genes and the same TCR encoding, see encode_tcr
+        :param keys: None or list of str, name of each cohort, by default the position of the adata
+        :param cohort_key: str, column of obs holding the cohort of each cell, e.g. to use as conditional variable
+        """
+        self.adatas = list(adatas)
+        self.keys = [str(i) for i in range(len(self.adatas))] if keys is None else [str(key) for key in keys]
+        self.cohort_key = cohort_key
+        if len(self.keys) != len(self.adatas):
+            raise ValueError('Please specify one key per adata.')
+
+        first = self.adatas[0]
+        for adata in self.adatas[1:]:
+            if not first.var_names.equals(adata.var_names):
+                raise ValueError('All adatas of a collection need the same genes in the same order.')
+            if 'aa_to_id' in first.uns and adata.uns['aa_to_id'] != first.uns['aa_to_id']:
+                raise ValueError('All adatas of a collection need the same TCR encoding.')
+        self.uns = first.uns
+        self.var = first.var
+        self.var_names = first.var_names
+
+        self.offsets = np.cumsum([0] + [adata.n_obs for adata in self.adatas])
+        self.obs = self.concatenate_obs()
+        self.obsm = ConcatObsm(self.adatas)
+
+    def concatenate_obs(self):
+        obs = pd.concat([adata.obs for adata in self.adatas])
+        if not obs.index.is_unique:
+            # the same barcodes appear in several cohorts
+            obs.index = np.concatenate([adata.obs_names + f'-{key}' for adata, key in zip(self.adatas, self.keys)])
+        cohorts = np.repeat(np.arange(len(self.adatas)), np.diff(self.offsets))
+        obs[self.cohort_key] = pd.Categorical.from_codes(cohorts, categories=self.keys)
+        return obs
+
+    @property
+    def n_obs(self):
+        return int(self.offsets[-1])
+
+    @property
+    def n_vars(self):
+        return len(self.var_names)
+
+    @property
+    def shape(self):
+        return self.n_obs, self.n_vars
+
+    @property
+    def obs_names(self):
+        return self.obs.index
+
+    # the collection itself is never backed or a view, its adatas can be
+    isbacked = False
+    is_view = False
+
+    def __len__(self):
+        return self.n_obs
+
+    def __getitem__(self, index):
+        """
+        Subset the cells, each adata is subset on its own and the cohorts keep their order
+        :param index: boolean mask or integer positions of the cells
+        :return: AnnDataCollection
+        """
+        positions = np.sort(np.arange(self.n_obs)[np.asarray(index)])
+        adatas = []
+        for adata, start, end in zip(self.adatas, self.offsets[:-1], self.offsets[1:]):
+            local = positions[(positions >= start) & (positions < end)] - start
+            adatas.append(adata[local])
+        return AnnDataCollection(adatas, self.keys, self.cohort_key)
+
+
+class ConcatObsm(Mapping):
+    def __init__(self, adatas):
+        """
+        obsm of a collection, arrays are concatenated when they are accessed
+        :param adatas: list of adatas
+        """
+        self.adatas = adatas
+
+    def __getitem__(self, key):
+        return np.concatenate([np.asarray(adata.obsm[key]) for adata in self.adatas])
+
+    def __contains__(self, key):
+        return all(key in adata.obsm for adata in self.adatas)
+
+    def __iter__(self):
+        return iter([key for key in self.adatas[0].obsm.keys() if key in self])
+
+    def __len__(self):
+        return len(list(iter(self)))
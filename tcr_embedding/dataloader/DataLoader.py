@@ -1,24 +1,318 @@
+import os
 import numpy as np
-import pandas as pd
 import torch
-from torch.utils.data import DataLoader, WeightedRandomSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, BatchSampler
+import pandas as pd
+from scipy import sparse
 import random
+import queue
+import threading
 
-from tcr_embedding.dataloader.Dataset import JointDataset
+from tcr_embedding.dataloader.Dataset import JointDataset, SparseRnaData, BackedReader, BackedRnaData
+from tcr_embedding.dataloader import Sampler
+from tcr_embedding.dataloader import TensorCache
+from tcr_embedding.dataloader.Collection import AnnDataCollection
+from tcr_embedding.dataloader.Bundle import TrainingBundle
+from tcr_embedding.utils_preprocessing import get_token_dtype
 
 
-def create_datasets(adata, val_split, metadata=None, conditional=None, labels=None, beta_only=False):
+def complete_params_loader(params):
     """
-    Create torch Dataset, see above for the input
-    :param adata: list of adatas
-    :param val_split:
-    :param metadata:
-    :param conditional:
-    :param labels:
-    :return: train_dataset, val_dataset, train_masks (for continuing training)
+    Fill in the default values of the data loading parameters, i.e. params_architecture['loader']
+    :param params: None or dict
+        chunk_size: int, number of consecutive rows read at once when passing over a whole backed adata.X,
+                    e.g. for the library sizes, batches only read their own rows
+        device_resident: bool, place the train and val tensors on the model device once and draw batches there
+        num_workers: int, number of DataLoader worker processes, 0 prepares the batches in the training process
+        pin_memory: bool, return batches in page-locked memory for faster transfer to the GPU
+        persistent_workers: bool, keep the workers alive between epochs
+        prefetch_factor: int, number of batches prepared in advance by each worker
+        sampling_mode: str, how balanced_sampling is done, 'weighted' draws with replacement weighted by the log
+                       class size, 'capped' draws at most sampling_cap cells of each class per epoch without replacement
+        sampling_cap: int, maximum number of cells per class and epoch for sampling_mode 'capped'
+        trim_tcr: bool, cut the TCR padding of each batch to its longest chain, set by models with
+                  params_tcr['variable_length']
+        length_bucketing: None or bool, group training cells of similar CDR3 length into the same batches,
+                          None follows trim_tcr
+        bucket_batches: int, number of consecutive batches whose cells are sorted by length
+        prefetch_batches: int, number of batches prepared in a background thread during training and inference,
+                          0 prepares each batch when it is needed
+        cache_dir: None or str, directory to store the encoded tensors of in-memory adatas, see encode_tensors
+        rna_dtype: str, storage dtype of the gene expression, 'float32', 'float16' or 'bfloat16', caches in cache_dir
+                   store the matrix in this dtype, bundles in the rna_dtype of export_bundle, for training the X of an
+                   in-memory adata without cache_dir needs to be dense float16 already, other data is used as it is
+                   stored for predictions, batches are upcast to float32 on the model device
+        normalize_counts: bool, the gene expression holds raw counts, which are normalized to target_sum and log1p
+                          transformed per batch, so no normalized copy of the matrix needs to be stored
+        counts_layer: None or str, read the raw counts from adata.layers[counts_layer] instead of adata.X
+        library_size_key: None or str, column of adata.obs with the total counts of each cell, e.g. when adata only
+                          holds the highly variable genes, by default the counts of each cell are summed up
+        target_sum: None or float, total counts after normalization, None uses the median library size as
+                    scanpy.pp.normalize_total, the model keeps the value of its training data
+        conditional_categories: None or list, labels of a conditional adata.obs column in the order of their codes,
+                                the model keeps the labels of its training data, see get_conditional_codes
+        use_rna: bool, load the gene expression, set by the model, otherwise batches hold an empty rna tensor
+        use_tcr: bool, load the TCR sequences, set by the model, otherwise batches hold empty tcr tensors
+    :return: dict with all data loading parameters
+    """
+    params = {} if params is None else dict(params)
+    default_values = {
+        'chunk_size': 16384,
+        'device_resident': False,
+        'num_workers': 0,
+        'pin_memory': torch.cuda.is_available(),
+        'persistent_workers': True,
+        'prefetch_factor': 2,
+        'sampling_mode': 'weighted',
+        'sampling_cap': 10,
+        'trim_tcr': False,
+        'length_bucketing': None,
+        'bucket_batches': 50,
+        'prefetch_batches': 0,
+        'cache_dir': None,
+        'rna_dtype': 'float32',
+        'normalize_counts': False,
+        'counts_layer': None,
+        'library_size_key': None,
+        'target_sum': None,
+        'conditional_categories': None,
+        'use_rna': True,
+        'use_tcr': True,
+    }
+    for key, value in default_values.items():
+        if key not in params:
+            params[key] = value
+    return params
+
+
+def get_rna_dtype(params_loader):
+    """
+    Get the storage dtype of the gene expression
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    :return: torch.dtype
+    """
+    dtypes = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+    if params_loader['rna_dtype'] not in dtypes:
+        raise ValueError(f'Unknown rna_dtype {params_loader["rna_dtype"]}, please choose one of {list(dtypes)}.')
+    return dtypes[params_loader['rna_dtype']]
+
+
+def has_rna_dtype(adata, rna, params_loader):
+    """
+    Check whether the gene expression is already stored in the storage dtype, a converted copy would be held in
+    addition to adata.X and take more memory than it saves
+    :param adata: adata, AnnDataCollection or TrainingBundle
+    :param rna: gene expression returned by get_rna or memory-mapped from the cache, see encode_tensors
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    :return: bool
+    """
+    if isinstance(adata, AnnDataCollection):
+        return all(has_rna_dtype(part, rna_part, params_loader) for part, rna_part in zip(adata.adatas, rna))
+    dtype = get_rna_dtype(params_loader)
+    # bundles store the matrix in their own dtype, backed files only hold the rows of the current batch in memory
+    if dtype == torch.float32 or rna is None or isinstance(adata, TrainingBundle) or isinstance(rna, BackedRnaData):
+        return True
+    if isinstance(rna, SparseRnaData):
+        rna = rna.data
+    if torch.is_tensor(rna):
+        return rna.dtype == dtype
+    # scipy has no 16 bit floats and numpy no bfloat16
+    return not sparse.issparse(rna) and rna.dtype == params_loader['rna_dtype']
+
+
+def check_rna_dtype(dataset, params_loader):
+    """
+    Make sure the training data is stored in the storage dtype, see create_datasets
+    :param dataset: JointDataset
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    """
+    dtype = params_loader['rna_dtype']
+    if dataset.rna_dtype == get_rna_dtype(params_loader):
+        return
+    advice = f'Please set params_loader["cache_dir"] or use a bundle exported with rna_dtype="{dtype}"'
+    if dtype == 'float16':
+        advice += ', or convert a dense adata.X to float16'
+    raise ValueError(f'params_loader["rna_dtype"] is {dtype}, but the gene expression of the training data is not '
+                     f'stored in {dtype}. {advice}.')
+
+
+def get_backed_rows(adata):
+    """
+    Get the on-disk gene expression matrix of a backed adata, without loading it into memory
+    :param adata: adata opened with backed='r', can be a view
+    :return: backed X of the h5ad file, np.array with the row of each cell of adata in the file
+    """
+    if not adata.is_view:
+        return adata.X, np.arange(adata.n_obs)
+    # X of a backed view is loaded into memory, so its rows are taken from the parent adata, which holds the open
+    # file. Views of backed adatas can't be nested, so _oidx always indexes into the whole file.
+    adata_file = adata._adata_ref
+    return adata_file.X, np.arange(adata_file.n_obs)[adata._oidx]
+
+
+def encode_metadata(adata, metadata):
+    """
+    Encode the metadata columns as integer codes, so no Python object is held per cell
+    :param adata: adata
+    :param metadata: list of str, columns of adata.obs
+    :return: np.array shape=[num_cells, num_metadata] with the codes (-1 for missing values),
+             list with the categories of each column to decode them
+    """
+    codes = np.empty((adata.n_obs, len(metadata)), dtype=np.int32)
+    categories = []
+    for i, column in enumerate(metadata):
+        codes[:, i], uniques = pd.factorize(adata.obs[column])
+        categories.append(np.asarray(uniques))
+    return codes, categories
+
+
+def get_conditional_categories(adata, conditional):
+    """
+    Get the labels of the conditional variable in the order of their codes, see get_conditional_codes
+    :param adata: adata
+    :param conditional: str, either a one-hot-encoding in adata.obsm or a (categorical) column in adata.obs
+    :return: None for a one-hot-encoding, else list of labels
+    """
+    if conditional in adata.obsm:
+        return None
+    return adata.obs[conditional].astype('category').cat.categories.tolist()
+
+
+def get_conditional_codes(adata, conditional, categories=None):
+    """
+    Get the label of the conditional variable for each cell
+    :param adata: adata
+    :param conditional: str, either a one-hot-encoding in adata.obsm or a (categorical) column in adata.obs
+    :param categories: None or list of labels, e.g. of the training data, to encode subsets and new data with the
+                       same codes, None uses the labels present in adata, see get_conditional_categories
+    :return: np.array of int64 labels
+    """
+    if conditional in adata.obsm:
+        # Reduce the one-hot-encoding back to labels
+        return np.asarray(adata.obsm[conditional]).argmax(1)
+    values = adata.obs[conditional]
+    if values.isna().any():
+        raise ValueError(f'The conditional variable adata.obs["{conditional}"] contains missing values.')
+    if categories is None:
+        categories = get_conditional_categories(adata, conditional)
+    codes = pd.Categorical(values, categories=categories).codes.astype(np.int64)
+    if (codes == -1).any():
+        unseen = pd.unique(values.to_numpy()[codes == -1])
+        raise ValueError(f'The conditional variable adata.obs["{conditional}"] contains labels unknown to the model: '
+                         f'{list(unseen)}, see VAEBaseModel.change_adata to add new labels.')
+    return codes
+
+
+def count_conditional_labels(adata, conditional, categories=None):
+    """
+    Get the number of labels of the conditional variable, see get_conditional_codes
+    :param adata: adata
+    :param conditional: str, either a one-hot-encoding in adata.obsm or a (categorical) column in adata.obs
+    :param categories: None or list of labels, see get_conditional_codes
+    :return: int
+    """
+    if conditional in adata.obsm:
+        return adata.obsm[conditional].shape[1]
+    if categories is not None:
+        return len(categories)
+    return len(get_conditional_categories(adata, conditional))
+
+
+def get_rna(adata, params_loader):
+    """
+    Get the gene expression in the form expected by JointDataset
+    :param adata: adata, AnnDataCollection or TrainingBundle
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    :return: np.array, scipy sparse matrix, SparseRnaData, BackedRnaData or a list of them for a collection
+    """
+    if isinstance(adata, AnnDataCollection):
+        return [get_rna(part, params_loader) for part in adata.adatas]
+    if params_loader['counts_layer'] is not None:
+        # layers are held in memory, also for backed adata
+        return adata.layers[params_loader['counts_layer']]
+    if adata.isbacked:
+        # only the rows of the current batch are read from disk
+        backed_x, rows = get_backed_rows(adata)
+        return BackedRnaData(BackedReader(backed_x, adata.filename), rows)
+    return adata.X
+
+
+def get_library_size(adata, params_loader):
+    """
+    Get the total counts of each cell for normalizing raw counts, see complete_params_loader
+    :param adata: adata, AnnDataCollection or TrainingBundle
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    :return: np.array of float32
+    """
+    if isinstance(adata, AnnDataCollection):
+        return np.concatenate([get_library_size(part, params_loader) for part in adata.adatas])
+    if params_loader['library_size_key'] is not None:
+        return adata.obs[params_loader['library_size_key']].to_numpy(dtype=np.float32)
+    if isinstance(adata, TrainingBundle):
+        # sums the memory-mapped CSR arrays
+        return adata.get_library_size(params_loader['counts_layer'])
+    if adata.isbacked and params_loader['counts_layer'] is None:
+        # a single pass over the file in blocks of consecutive rows
+        backed_x, rows = get_backed_rows(adata)
+        block_size = params_loader['chunk_size']
+        totals = [np.asarray(backed_x[start:start + block_size].sum(axis=1)).ravel()
+                  for start in range(0, backed_x.shape[0], block_size)]
+        return np.concatenate(totals).astype(np.float32)[rows]
+    # 16 bit values are summed up in float32
+    return np.asarray(get_rna(adata, params_loader).sum(axis=1, dtype=np.float32)).ravel()
+
+
+def encode_tensors(adata, val_split, metadata=None, conditional=None, beta_only=False, balanced_sampling=None,
+                   params_loader=None):
+    """
+    Encode the cells of adata into the arrays the datasets and samplers are built from
+    With params_loader['cache_dir'], the arrays of an in-memory adata are stored on disk keyed by a content hash,
+    later runs and trials on the same data memory-map them instead of encoding them again.
+    :param adata: adata, AnnDataCollection of several adatas or TrainingBundle
+    :param val_split: None or str, column of adata.obs with 'train' for training cells
+    :param metadata: list of str, columns of adata.obs, encoded as integer codes
+    :param conditional: str, one-hot-encoding in adata.obsm or column in adata.obs, see get_conditional_codes
+    :param beta_only: bool, only use the beta chain
+    :param balanced_sampling: None or str, column of adata.obs whose classes are balanced during sampling
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    :return: dict with rna (None without use_rna), tcr_seq, tcr_length, metadata, metadata_categories, conditional, train_mask,
+             sampling_labels (integer codes of balanced_sampling) and library_size (with normalize_counts),
+             see TensorCache
     """
     if metadata is None:
         metadata = []
+    params_loader = complete_params_loader(params_loader)
+    chains = ['beta'] if beta_only else ['alpha', 'beta']
+
+    # backed data and bundles are read lazily from their files anyway, collections are not cached
+    use_cache = (params_loader['cache_dir'] is not None and not adata.isbacked
+                 and not isinstance(adata, (AnnDataCollection, TrainingBundle)))
+    if use_cache:
+        settings = {'val_split': val_split, 'metadata': list(metadata), 'conditional': conditional,
+                    'beta_only': beta_only, 'balanced_sampling': balanced_sampling,
+                    'normalize_counts': params_loader['normalize_counts'],
+                    'counts_layer': params_loader['counts_layer'],
+                    'library_size_key': params_loader['library_size_key'],
+                    'conditional_categories': params_loader['conditional_categories'],
+                    'rna_dtype': params_loader['rna_dtype'],
+                    'use_rna': params_loader['use_rna'], 'use_tcr': params_loader['use_tcr']}
+        obs_columns = list(metadata)
+        obsm_keys = []
+        if params_loader['use_tcr']:
+            obs_columns += [f'{chain}_len' for chain in chains]
+            obsm_keys += [f'{chain}_seq' for chain in chains]
+        for column in [val_split, balanced_sampling, conditional, params_loader['library_size_key']]:
+            if column is not None and column in adata.obs:
+                obs_columns.append(column)
+        if conditional is not None and conditional in adata.obsm:
+            obsm_keys.append(conditional)
+        x = None
+        if params_loader['use_rna']:
+            x = adata.X if params_loader['counts_layer'] is None else adata.layers[params_loader['counts_layer']]
+        path_cache = os.path.join(params_loader['cache_dir'], TensorCache.hash_adata(adata, obs_columns, obsm_keys,
+                                                                                     settings, x))
+        if os.path.exists(path_cache):
+            return TensorCache.load_tensors(path_cache)
 
     # Splits everything into train and val
     if val_split is not None:
@@ -26,36 +320,77 @@ def create_datasets(adata, val_split, metadata=None, conditional=None, labels=No
     else:
         train_mask = np.ones(shape=(len(adata), ), dtype=bool)
 
-    # Save dataset splits
-    rna_train = adata.X[train_mask]
-    rna_val = adata.X[~train_mask]
+    # modalities the model doesn't use are neither read nor held in memory
+    rna = get_rna(adata, params_loader) if params_loader['use_rna'] else None
 
-    if beta_only:
-        tcr_seq = np.concatenate([adata.obsm['beta_seq']], axis=1)
-        tcr_length = np.vstack([adata.obs['beta_len']]).T
+    if params_loader['use_tcr']:
+        tcr_seq = np.concatenate([adata.obsm[f'{chain}_seq'] for chain in chains], axis=1)
+        tcr_length = np.vstack([adata.obs[f'{chain}_len'] for chain in chains]).T
+        # adatas encoded before the compact storage still hold int64 tokens
+        tcr_seq = tcr_seq.astype(get_token_dtype(int(tcr_seq.max()) + 1), copy=False)
+        tcr_length = tcr_length.astype(get_token_dtype(tcr_seq.shape[1] + 1), copy=False)
     else:
-        tcr_seq = np.concatenate([adata.obsm['alpha_seq'], adata.obsm['beta_seq']], axis=1)
-        tcr_length = np.vstack([adata.obs['alpha_len'], adata.obs['beta_len']]).T
-    tcr_train = tcr_seq[train_mask]
-    tcr_val = tcr_seq[~train_mask]
-
-    tcr_length_train = tcr_length[train_mask].tolist()
-    tcr_length_val = tcr_length[~train_mask].tolist()
+        tcr_seq = np.zeros((adata.n_obs, 0), dtype=np.uint8)
+        tcr_length = np.zeros((adata.n_obs, 0), dtype=np.uint8)
 
-    metadata_train = adata.obs[metadata][train_mask].to_numpy()
-    metadata_val = adata.obs[metadata][~train_mask].to_numpy()
+    metadata, metadata_categories = encode_metadata(adata, metadata)
 
     if conditional is not None:
-        conditional_train = adata.obsm[conditional][train_mask]
-        conditional_val = adata.obsm[conditional][~train_mask]
-    else:
-        conditional_train = None
-        conditional_val = None
+        conditional = get_conditional_codes(adata, conditional, params_loader['conditional_categories'])
+
+    sampling_labels = None
+    if balanced_sampling is not None:
+        sampling_labels = pd.factorize(adata.obs[balanced_sampling])[0]
+
+    library_size = None
+    if params_loader['normalize_counts'] and params_loader['use_rna']:
+        library_size = get_library_size(adata, params_loader)
 
-    train_dataset = JointDataset(rna_train, tcr_train, tcr_length_train, metadata_train,
-                                 None, conditional_train)
-    val_dataset = JointDataset(rna_val, tcr_val, tcr_length_val, metadata_val,
-                               None, conditional_val)
+    tensors = {'rna': rna, 'tcr_seq': tcr_seq, 'tcr_length': tcr_length, 'metadata': metadata,
+               'metadata_categories': metadata_categories, 'conditional': conditional, 'train_mask': train_mask,
+               'sampling_labels': sampling_labels, 'library_size': library_size}
+    if use_cache:
+        TensorCache.save_tensors(path_cache, tensors, params_loader['rna_dtype'])
+        # the memory-mapped arrays replace the in-memory ones, so all trials share the same pages
+        return TensorCache.load_tensors(path_cache)
+    return tensors
+
+
+def create_datasets(adata, val_split, metadata=None, conditional=None, labels=None, beta_only=False,
+                    params_loader=None, device=None, tensors=None):
+    """
+    Create torch Dataset, see above for the input
+    :param adata: adata or AnnDataCollection of several adatas
+    :param val_split:
+    :param metadata: list of str, columns of adata.obs, encoded as integer codes
+    :param conditional: str, one-hot-encoding in adata.obsm or column in adata.obs, see get_conditional_codes
+    :param labels:
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    :param device: None or torch.device, if specified all tensors are placed on this device
+    :param tensors: None or dict of already encoded arrays, see encode_tensors
+    :return: train_dataset, val_dataset, train_masks (for continuing training)
+    """
+    params_loader = complete_params_loader(params_loader)
+    if tensors is None:
+        tensors = encode_tensors(adata, val_split, metadata, conditional, beta_only, params_loader=params_loader)
+    train_mask = np.asarray(tensors['train_mask'])
+
+    rna_dtype = get_rna_dtype(params_loader)
+    if not has_rna_dtype(adata, tensors['rna'], params_loader):
+        # the data is used as it is stored and upcast per batch, e.g. a model trained on a float16 bundle embedding a
+        # float32 adata, training checks the storage dtype, see check_rna_dtype
+        rna_dtype = torch.float32
+
+    # train and val set are index views on the same tensors, so the data is held only once
+    dataset = JointDataset(tensors['rna'], tensors['tcr_seq'], tensors['tcr_length'], tensors['metadata'], None,
+                           tensors['conditional'], trim_tcr=params_loader['trim_tcr'] and params_loader['use_tcr'],
+                           metadata_categories=tensors['metadata_categories'],
+                           rna_dtype=rna_dtype, library_size=tensors['library_size'],
+                           target_sum=params_loader['target_sum'])
+    if device is not None:
+        dataset.to(device)
+    train_dataset = dataset.subset(np.where(train_mask)[0])
+    val_dataset = dataset.subset(np.where(~train_mask)[0])
 
     return train_dataset, val_dataset, train_mask
 
@@ -66,21 +401,166 @@ def seed_worker(worker_id):
     random.seed(worker_seed)
 
 
+def create_batch_loader(dataset, batch_size, sampler, params_loader=None, length_bucketing=False):
+    """
+    Create a DataLoader that fetches whole batches from the dataset, instead of single cells + default_collate
+    :param dataset: JointDataset
+    :param batch_size: int, batch size
+    :param sampler: torch Sampler yielding single indices, e.g. RandomSampler or WeightedRandomSampler
+    :param params_loader: dict of data loading parameters, see complete_params_loader
+    :param length_bucketing: bool, group cells of similar CDR3 length into the same batches
+    :return: torch DataLoader yielding batches as returned by JointDataset.__getitem__
+    """
+    params_loader = complete_params_loader(params_loader)
+    if length_bucketing:
+        lengths = torch.from_numpy(dataset.tcr_max_length[dataset.indices])
+        batch_sampler = Sampler.LengthBucketBatchSampler(sampler, lengths, batch_size, params_loader['bucket_batches'])
+    else:
+        batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=False)
+
+    num_workers = params_loader['num_workers']
+    worker_params = {}
+    if num_workers > 0:
+        # forked workers only read the tensors, which wrap numpy arrays or memory-mapped files, so their pages are
+        # shared with this process without copying them into shared memory
+        worker_params = {'persistent_workers': params_loader['persistent_workers'],
+                         'prefetch_factor': params_loader['prefetch_factor']}
+    # batch_size=None disables automatic batching, so the dataset receives the list of indices of each batch
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None, worker_init_fn=seed_worker,
+                      num_workers=num_workers, pin_memory=params_loader['pin_memory'], **worker_params)
+
+
+class DeviceBatchLoader:
+    def __init__(self, dataset, batch_size, shuffle=False, sampler=None, bucket_batches=None):
+        """
+        Iterates over a JointDataset whose tensors are placed on the device, batch indices are drawn on the device
+        :param dataset: JointDataset after JointDataset.to(device)
+        :param batch_size: int, batch size
+        :param shuffle: bool, draw a random permutation each epoch
+        :param sampler: None or balanced sampler from Sampler.create_balanced_sampler, placed on the same device
+        :param bucket_batches: None or int, if int group cells of similar CDR3 length, see Sampler.bucket_by_length
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.bucket_batches = bucket_batches
+        self.device = dataset.tcr_data.device
+        self.lengths = torch.from_numpy(dataset.tcr_max_length[dataset.indices]).to(self.device)
+
+    def __len__(self):
+        num_samples = len(self.dataset) if self.sampler is None else len(self.sampler)
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        num_samples = len(self.dataset)
+        if self.sampler is not None:
+            order = self.sampler.sample_epoch()
+        elif self.shuffle:
+            order = torch.randperm(num_samples, device=self.device)
+        else:
+            order = torch.arange(num_samples, device=self.device)
+        if self.bucket_batches is not None:
+            batches = Sampler.bucket_by_length(order, self.lengths, self.batch_size, self.bucket_batches)
+        else:
+            batches = order.split(self.batch_size)
+        # a single transfer per epoch for indexing the metadata on the host
+        order_host = torch.cat(batches).cpu().numpy()
+        start = 0
+        for batch in batches:
+            stop = start + len(batch)
+            yield self.dataset.gather(batch, order_host[start:stop])
+            start = stop
+
+
+class BatchPrefetcher:
+    def __init__(self, loader, num_batches):
+        """
+        Prepares the next batches of a loader in a background thread, while the current batch is processed
+        :param loader: iterable over batches, e.g. DataLoader or DeviceBatchLoader
+        :param num_batches: int, maximum number of batches prepared in advance
+        """
+        self.loader = loader
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        # the samplers draw all random numbers of the epoch before the first batch is returned,
+        # so sampling in the background doesn't interfere with the random numbers of the model
+        thread = threading.Thread(target=self.produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, exception = batches.get()
+                if exception is not None:
+                    raise exception
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            # also stops the thread, when the consumer leaves the loop early
+            stop.set()
+            thread.join()
+
+    def produce(self, batches, stop):
+        try:
+            for batch in self.loader:
+                if not self.put(batches, (batch, None), stop):
+                    return
+        except Exception as e:
+            self.put(batches, (None, e), stop)
+            return
+        self.put(batches, (None, None), stop)
+
+    @staticmethod
+    def put(batches, item, stop):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
 # <- functions for the main data loader ->
-def initialize_data_loader(adata, metadata, conditional, label_key, balanced_sampling, batch_size, beta_only=False):
+def initialize_data_loader(adata, metadata, conditional, label_key, balanced_sampling, batch_size, beta_only=False,
+                           params_loader=None, device=None):
+    params_loader = complete_params_loader(params_loader)
+    device_resident = params_loader['device_resident']
+    tensors = encode_tensors(adata, 'set', metadata, conditional, beta_only, balanced_sampling, params_loader)
     train_datasets, val_datasets, train_mask = create_datasets(adata, 'set', metadata, conditional, label_key,
-                                                               beta_only=beta_only)
+                                                               beta_only=beta_only, params_loader=params_loader,
+                                                               device=device if device_resident else None,
+                                                               tensors=tensors)
 
-    if balanced_sampling is None:
-        train_loader = DataLoader(train_datasets, batch_size=batch_size, shuffle=True, worker_init_fn=seed_worker)
-    else:
-        sampling_weights = calculate_sampling_weights(adata, train_mask, class_column=balanced_sampling)
-        sampler = WeightedRandomSampler(weights=sampling_weights, num_samples=len(sampling_weights),
-                                        replacement=True)
-        # shuffle is mutually exclusive to sampler, but sampler is anyway shuffled
-        train_loader = DataLoader(train_datasets, batch_size=batch_size, shuffle=False,
-                                  sampler=sampler, worker_init_fn=seed_worker)
-    val_loader = DataLoader(val_datasets, batch_size=batch_size, shuffle=False)
+    sampler = None
+    if balanced_sampling is not None:
+        sampler = Sampler.create_balanced_sampler(tensors['sampling_labels'][train_mask],
+                                                  params_loader['sampling_mode'], params_loader['sampling_cap'])
+
+    length_bucketing = params_loader['length_bucketing']
+    if length_bucketing is None:
+        length_bucketing = params_loader['trim_tcr']
+    length_bucketing = length_bucketing and params_loader['use_tcr']
+
+    if device_resident:
+        if sampler is not None:
+            sampler.to(device)
+        bucket_batches = params_loader['bucket_batches'] if length_bucketing else None
+        train_loader = DeviceBatchLoader(train_datasets, batch_size, shuffle=True, sampler=sampler,
+                                         bucket_batches=bucket_batches)
+        val_loader = DeviceBatchLoader(val_datasets, batch_size, shuffle=False)
+        return train_loader, val_loader
+
+    if sampler is None:
+        sampler = RandomSampler(train_datasets)
+    train_loader = create_batch_loader(train_datasets, batch_size, sampler, params_loader, length_bucketing)
+    val_loader = create_batch_loader(val_datasets, batch_size, SequentialSampler(val_datasets), params_loader)
     return train_loader, val_loader
 
 
@@ -88,36 +568,27 @@ def calculate_sampling_weights(adata, train_mask, class_column):
     """
     Calculate sampling weights for more balanced sampling in case of imbalanced classes,
     :params class_column: str, key for class to be balanced
-    :params log_divisor: divide the label counts by this factor before taking the log, higher number makes the sampling more uniformly balanced
-    :return: list of weights
+    :return: np.array of weights
     """
-    label_counts = []
-
-    label_count = adata[train_mask].obs[class_column].map(adata[train_mask].obs[class_column].value_counts())
-    label_counts.append(label_count)
-
-    label_counts = pd.concat(label_counts, ignore_index=True)
-    label_counts = np.log(label_counts / 10 + 1)
-    label_counts = 1 / label_counts
-
-    sampling_weights = label_counts / sum(label_counts)
-    return sampling_weights
+    # use obs directly, since backed adata can't be subset repeatedly
+    return Sampler.calculate_sampling_weights(adata.obs[class_column].values[train_mask])
 
 
 # <- data loader for prediction ->
-def initialize_prediction_loader(adata, metadata, batch_size, beta_only=False, conditional=None):
+def initialize_prediction_loader(adata, metadata, batch_size, beta_only=False, conditional=None, params_loader=None):
     prediction_dataset, _, _ = create_datasets(adata, val_split=None, conditional=conditional,
-                                               metadata=metadata, beta_only=beta_only)
-    prediction_loader = DataLoader(prediction_dataset, batch_size=batch_size, shuffle=False)
+                                               metadata=metadata, beta_only=beta_only, params_loader=params_loader)
+    prediction_loader = create_batch_loader(prediction_dataset, batch_size, SequentialSampler(prediction_dataset),
+                                            params_loader)
     return prediction_loader
 
 
 # <- data loader for calculating the transcriptome from the latent space ->
-def initialize_latent_loader(adata_latent, batch_size, conditional):
+def initialize_latent_loader(adata_latent, batch_size, conditional, conditional_categories=None):
     if conditional is None:
         dataset = torch.utils.data.TensorDataset(torch.from_numpy(adata_latent.X))
     else:
-        dataset = torch.utils.data.TensorDataset(torch.from_numpy(adata_latent.X),
-                                                 torch.from_numpy(adata_latent.obsm[conditional]))
+        codes = get_conditional_codes(adata_latent, conditional, conditional_categories)
+        dataset = torch.utils.data.TensorDataset(torch.from_numpy(adata_latent.X), torch.from_numpy(codes))
     latent_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
     return latent_loader
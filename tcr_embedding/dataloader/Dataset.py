@@ -1,5 +1,8 @@
+import os
+import copy
 import torch
 import numpy as np
+import anndata
 from scipy import sparse
 
 
@@ -11,61 +14,357 @@ class JointDataset(torch.utils.data.Dataset):
 			tcr_length,
 			metadata,
 			labels=None,
-			conditional=None
+			conditional=None,
+			trim_tcr=False,
+			metadata_categories=None,
+			rna_dtype=torch.float32,
+			library_size=None,
+			target_sum=None
 	):
 		"""
-		:param rna_data: list of gene expressions, where each element is a numpy or sparse matrix of one dataset
+		:param rna_data: list of gene expressions, where each element is a numpy or sparse matrix of one dataset,
+						 None if the model doesn't use the gene expression
 		:param tcr_data: list of seq_data, where each element is a seq_list of one dataset
 		:param tcr_length: list of non-padded sequence length, needed for many architectures to mask the padding out
-		:param metadata: list of metadata
+		:param metadata: array of metadata, preferably integer codes shape=[num_cells, num_metadata]
 		:param labels: list of labels
-		:param conditional: list of conditionales
+		:param conditional: array of integer labels of the conditional variable
+		:param trim_tcr: bool, cut the padding of each chain in a batch down to the longest sequence of the batch
+		:param metadata_categories: None or list with the categories of each metadata column to decode the codes
+		:param rna_dtype: torch.dtype, storage dtype of the gene expression, e.g. torch.float16 to halve the memory,
+						  batches are returned in this dtype and upcast by the model, rna_data already in this dtype
+						  is used without a copy
+		:param library_size: None or array of the total counts of each cell, if given rna_data holds raw counts,
+							 which are normalized to target_sum and log1p transformed per batch
+		:param target_sum: None or float, total counts after normalization, None uses the median library size
 		"""
-		self.metadata = metadata.tolist()
-		self.tcr_length = torch.LongTensor(tcr_length)
+		self.metadata = np.asarray(metadata)
+		self.metadata_categories = metadata_categories
+		# tokens and lengths keep their compact storage dtype, e.g. uint8, the model widens them per batch
+		self.tcr_length = torch.as_tensor(np.asarray(tcr_length))
+		# longest chain of each cell, kept on the host to determine the trimmed batch length without device syncs
+		self.tcr_max_length = np.asarray(tcr_length).max(axis=1, initial=0)
+		self.trim_tcr = trim_tcr
 
 		if conditional is not None:
-			# Reduce the one-hot-encoding back to labels
-			self.conditional = torch.LongTensor(conditional.argmax(1))
-		# LongTensor since it is going to be embedded
+			# LongTensor since it is going to be embedded
+			self.conditional = torch.as_tensor(np.asarray(conditional), dtype=torch.long)
 		else:
 			self.conditional = None
 
+		self.rna_dtype = rna_dtype
 		self.rna_data = self.create_tensor(rna_data)
+
+		self.target_sum = target_sum
+		self.size_factors = None
+		if library_size is not None:
+			library_size = np.asarray(library_size, dtype=np.float32)
+			if self.target_sum is None:
+				# as scanpy.pp.normalize_total, cells without counts are ignored
+				self.target_sum = float(np.median(library_size[library_size > 0]))
+			size_factors = np.zeros_like(library_size)
+			np.divide(self.target_sum, library_size, out=size_factors, where=library_size > 0)
+			self.size_factors = torch.from_numpy(size_factors)
 		# self.size_factors = self.rna_data.sum(1)
 
-		self.tcr_data = torch.LongTensor(tcr_data)
+		self.tcr_data = torch.as_tensor(np.asarray(tcr_data))
 
 		if labels is not None:
-			self.labels = torch.LongTensor(self.labels)
+			self.labels = torch.LongTensor(labels)
 		else:
 			self.labels = None
 
+		# rows of the tensors belonging to this dataset, see subset
+		self.indices = np.arange(len(self.tcr_data))
+		self.indices_tensor = torch.from_numpy(self.indices)
+
 	def create_tensor(self, x):
+		if x is None:
+			return None
+		if isinstance(x, list):
+			# one part per adata of a collection, gathered per batch without concatenating them
+			return ConcatRnaData([self.create_tensor(part) for part in x])
+		if isinstance(x, BackedRnaData):
+			# only the rows of the current batch are in memory, so they are kept as float32
+			return x
+		if isinstance(x, SparseRnaData):
+			return x.to(dtype=self.rna_dtype)
 		if sparse.issparse(x):
-			x = x.todense()
-			return torch.FloatTensor(x)
+			# keep the CSR arrays, rows are only densified when they are requested
+			return SparseRnaData(x, self.rna_dtype)
 		else:
-			return torch.FloatTensor(x)
+			# shares the memory with x, if x already has the storage dtype
+			return torch.as_tensor(x, dtype=self.rna_dtype)
+
+	def subset(self, indices):
+		"""
+		Create a dataset on a subset of the cells, which shares all tensors with this dataset
+		:param indices: 1D np.array, positions of the cells within this dataset
+		:return: JointDataset
+		"""
+		view = copy.copy(self)
+		view.indices = self.indices[np.asarray(indices, dtype=np.int64)]
+		view.indices_tensor = torch.from_numpy(view.indices).to(self.indices_tensor.device)
+		return view
 
 	def __len__(self):
-		return len(self.rna_data)
+		return len(self.indices)
 
 	def __getitem__(self, idx):
-		if self.labels is None:
-			if self.conditional is None:
-				return self.rna_data[idx], self.tcr_data[idx], self.tcr_length[idx], \
-					   self.metadata[idx], False, False
-			else:
-				return self.rna_data[idx], self.tcr_data[idx], self.tcr_length[idx], \
-					   self.metadata[idx], False, self.conditional[idx]
-		else:
-			if self.conditional is None:
-				return self.rna_data[idx], self.tcr_datas[idx], self.tcr_lenght[idx], \
-					   self.metadata[idx], self.labels[idx], False
-			else:
-				return self.rna_data[idx], self.tcr_datas[idx], self.tcr_lenght[idx], \
-					   self.metadata[idx], self.labels[idx], self.conditional[idx]
+		"""
+		Gather a single cell or a whole batch of cells
+		:param idx: int or list of indices, a list of indices is gathered with one fancy-indexing call per tensor
+		:return: rna, tcr, tcr_length, metadata, labels, conditional (False for missing labels and conditional)
+		"""
+		if np.ndim(idx) == 0:
+			row = self.indices[idx]
+			labels = self.labels[row] if self.labels is not None else False
+			conditional = self.conditional[row] if self.conditional is not None else False
+			return self.get_rna(row), self.tcr_data[row], self.tcr_length[row], self.metadata[row].tolist(), \
+				labels, conditional
+		rows = self.indices[np.asarray(idx, dtype=np.int64)]
+		return self.gather_rows(torch.from_numpy(rows), rows)
+
+	def gather(self, idx, idx_host):
+		"""
+		Gather a batch of cells
+		:param idx: torch.LongTensor, positions within this dataset, on the same device as the dataset tensors
+		:param idx_host: np.array, the same positions on the host, used for the metadata
+		:return: rna, tcr, tcr_length, metadata, labels, conditional (False for missing labels and conditional)
+		"""
+		return self.gather_rows(self.indices_tensor[idx], self.indices[idx_host])
+
+	def gather_rows(self, rows, rows_host):
+		labels = self.labels[rows] if self.labels is not None else False
+		conditional = self.conditional[rows] if self.conditional is not None else False
+		tcr = self.tcr_data[rows]
+		if self.trim_tcr:
+			tcr = self.trim_padding(tcr, rows_host)
+		return self.get_rna(rows), tcr, self.tcr_length[rows], self.metadata[rows_host], labels, conditional
+
+	def get_rna(self, rows):
+		if self.rna_data is None:
+			# an empty tensor keeps the batch size without holding or transferring any gene expression
+			return torch.zeros(torch.as_tensor(rows).shape + (0, ), device=self.indices_tensor.device)
+		rna = self.rna_data[rows]
+		if self.size_factors is not None:
+			# library-size normalization and log1p of the raw counts, in float32 to keep large counts exact
+			rna = torch.log1p(rna.float() * self.size_factors[rows].unsqueeze(-1))
+		return rna
+
+	def trim_padding(self, tcr, rows_host):
+		"""
+		Cut the padding of each chain to the longest chain in the batch
+		:param tcr: torch.LongTensor, shape=[batch_size, num_chains * max_tcr_length]
+		:param rows_host: np.array, rows of the batch
+		:return: torch.LongTensor, shape=[batch_size, num_chains * seq_len]
+		"""
+		num_chains = self.tcr_length.shape[1]
+		# the decoders need at least one input and one target position
+		seq_len = max(int(self.tcr_max_length[rows_host].max()), 2)
+		return tcr.view(len(tcr), num_chains, -1)[:, :, :seq_len].reshape(len(tcr), -1)
+
+	def to(self, device):
+		"""
+		Move all tensors to the device, so batches can be gathered there without host to device copies.
+		Call this before subset, otherwise each subset holds its own copy on the device.
+		:param device: torch.device
+		:return: self
+		"""
+		if self.rna_data is not None:
+			self.rna_data = self.rna_data.to(device)
+		self.tcr_data = self.tcr_data.to(device)
+		self.tcr_length = self.tcr_length.to(device)
+		if self.conditional is not None:
+			self.conditional = self.conditional.to(device)
+		if self.labels is not None:
+			self.labels = self.labels.to(device)
+		if self.size_factors is not None:
+			self.size_factors = self.size_factors.to(device)
+		self.indices_tensor = self.indices_tensor.to(device)
+		return self
+
+
+class SparseRnaData:
+	def __init__(self, x, dtype=torch.float32):
+		"""
+		Gene expression stored as CSR arrays, indexing returns dense rows
+		:param x: scipy sparse matrix of shape [num_cells, num_genes]
+		:param dtype: torch.dtype of the stored values and the returned rows
+		"""
+		x = sparse.csr_matrix(x)
+		if not x.has_canonical_format:
+			x = x.copy()
+			x.sum_duplicates()
+		self.set_arrays(x.data, x.indices, x.indptr, x.shape, dtype)
+
+	@classmethod
+	def from_arrays(cls, data, indices, indptr, shape, dtype=torch.float32):
+		"""
+		Create from the arrays of a canonical CSR matrix, e.g. memory-mapped ones, without copying them
+		:param data: np.array or torch.Tensor of the stored values
+		:param indices: np.array of the column indices
+		:param indptr: np.array of the row pointers
+		:param shape: tuple, [num_cells, num_genes]
+		:param dtype: torch.dtype of the stored values and the returned rows
+		:return: SparseRnaData
+		"""
+		rna_data = cls.__new__(cls)
+		rna_data.set_arrays(data, indices, indptr, shape, dtype)
+		return rna_data
+
+	def set_arrays(self, data, indices, indptr, shape, dtype):
+		self.shape = shape
+		# without copies, the arrays are shared with x where the dtypes already match
+		self.indptr = torch.from_numpy(indptr.astype(np.int64, copy=False))
+		self.indices = torch.from_numpy(indices.astype(np.int32, copy=False))
+		self.data = torch.as_tensor(data).to(dtype)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getitem__(self, idx):
+		"""
+		Densify the requested rows
+		:param idx: int or 1D array of row indices
+		:return: torch.Tensor of the storage dtype, shape=[num_genes] for int or [len(idx), num_genes] for arrays
+		"""
+		single_row = np.ndim(idx) == 0
+		device = self.data.device
+		idx = torch.as_tensor(idx, dtype=torch.long, device=device).reshape(-1)
+
+		starts = self.indptr[idx]
+		lengths = self.indptr[idx + 1] - starts
+		# position of every stored value of the requested rows within indices / data
+		row_offsets = torch.cumsum(lengths, dim=0) - lengths
+		positions = (torch.arange(int(lengths.sum()), device=device)
+					 + torch.repeat_interleave(starts - row_offsets, lengths))
+		rows = torch.repeat_interleave(torch.arange(len(idx), device=device), lengths)
+
+		dense = torch.zeros(len(idx), self.shape[1], device=device, dtype=self.data.dtype)
+		dense[rows, self.indices[positions].long()] = self.data[positions]
+		if single_row:
+			return dense[0]
+		return dense
+
+	def to(self, device=None, dtype=None):
+		if device is not None:
+			self.indptr = self.indptr.to(device)
+			self.indices = self.indices.to(device)
+		self.data = self.data.to(device=device, dtype=dtype)
+		return self
+
+
+# backed adatas opened by DataLoader workers, see open_backed
+BACKED_FILES = {}
+
+
+def open_backed(filename):
+	"""
+	Open an h5ad file in backed mode once per process, h5py file handles can't be used from forked processes
+	:param filename: str, h5ad file
+	:return: backed adata
+	"""
+	key = (filename, os.getpid())
+	if key not in BACKED_FILES:
+		BACKED_FILES[key] = anndata.read_h5ad(filename, backed='r')
+	return BACKED_FILES[key]
+
+
+class BackedReader:
+	def __init__(self, x, filename=None):
+		"""
+		Reads rows of an on-disk gene expression matrix, only the rows of the requested batch are read
+		:param x: backed adata.X, i.e. h5py.Dataset (dense) or backed sparse dataset (sparse)
+		:param filename: None or str, h5ad file of x, needed to reopen the file in DataLoader workers
+		"""
+		self.x = x
+		self.shape = x.shape
+		self.filename = filename
+		self.pid = os.getpid()
+
+	def gather(self, rows):
+		"""
+		Read the rows with a single fancy-indexed read, which needs increasing and unique row indices
+		:param rows: 1D np.array of row indices in the file
+		:return: torch.FloatTensor, shape=[len(rows), num_genes]
+		"""
+		if self.filename is not None and os.getpid() != self.pid:
+			self.x = open_backed(self.filename).X
+			self.pid = os.getpid()
+		unique_rows, inverse = np.unique(rows, return_inverse=True)
+		values = self.x[unique_rows]
+		if sparse.issparse(values):
+			values = values.toarray()
+		values = torch.from_numpy(np.asarray(values, dtype=np.float32))
+		return values[torch.from_numpy(inverse.reshape(-1))]
+
+
+class BackedRnaData:
+	def __init__(self, reader, rows):
+		"""
+		Gene expression of a subset of cells from an on-disk matrix, rows are read batch by batch
+		:param reader: BackedReader of the backed matrix
+		:param rows: 1D np.array, row indices of the cells in the backed matrix
+		"""
+		self.reader = reader
+		self.rows = np.asarray(rows, dtype=np.int64)
+		self.shape = (len(self.rows), reader.shape[1])
+
+	def __len__(self):
+		return self.shape[0]
+
+	def to(self, device=None, dtype=None):
+		raise ValueError('Backed adata can not be placed on the device, please load it into memory first.')
+
+	def __getitem__(self, idx):
+		if np.ndim(idx) == 0:
+			return self.reader.gather(self.rows[[idx]])[0]
+		return self.reader.gather(self.rows[np.asarray(idx)])
+
+
+class ConcatRnaData:
+	def __init__(self, parts):
+		"""
+		Gene expression of several datasets as one matrix, the rows of a batch are gathered from each part
+		:param parts: list of torch.Tensor, SparseRnaData or BackedRnaData with the same number of genes
+		"""
+		self.parts = parts
+		self.offsets = torch.as_tensor(np.cumsum([0] + [len(part) for part in parts]), dtype=torch.long)
+		self.shape = (int(self.offsets[-1]), parts[0].shape[1])
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getitem__(self, idx):
+		"""
+		Gather the requested rows
+		:param idx: int or 1D array of row indices
+		:return: torch.Tensor, shape=[num_genes] for int or [len(idx), num_genes] for arrays
+		"""
+		single_row = np.ndim(idx) == 0
+		rows = torch.as_tensor(idx, dtype=torch.long, device=self.offsets.device).reshape(-1)
+		part_ids = torch.searchsorted(self.offsets[1:], rows, right=True)
+		batch = None
+		for i, part in enumerate(self.parts):
+			positions = (part_ids == i).nonzero().squeeze(1)
+			if len(positions) == 0:
+				continue
+			values = part[rows[positions] - self.offsets[i]]
+			if batch is None:
+				batch = torch.zeros(len(rows), self.shape[1], dtype=values.dtype, device=values.device)
+			batch[positions.to(values.device)] = values
+		if batch is None:
+			batch = torch.zeros(0, self.shape[1])
+		if single_row:
+			return batch[0]
+		return batch
+
+	def to(self, device=None, dtype=None):
+		self.parts = [part.to(device=device, dtype=dtype) for part in self.parts]
+		if device is not None:
+			self.offsets = self.offsets.to(device)
+		return self
 
 
 class DeepTCRDataset(torch.utils.data.Dataset):
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Sampler, WeightedRandomSampler
+
+
+def encode_groups(labels):
+    """
+    Encode the class of each cell as integer, missing values form a group of their own
+    :param labels: 1D array-like, class of each cell, e.g. clonotype
+    :return: np.array with the group code of each cell, np.array with the number of cells per group
+    """
+    codes, _ = pd.factorize(np.asarray(labels))
+    codes[codes == -1] = codes.max() + 1
+    counts = np.bincount(codes)
+    return codes, counts
+
+
+def calculate_sampling_weights(labels):
+    """
+    Calculate sampling weights for more balanced sampling in case of imbalanced classes
+    :param labels: 1D array-like, class of each cell, e.g. clonotype
+    :return: np.array of weights summing up to 1
+    """
+    codes, counts = encode_groups(labels)
+    weights = 1. / np.log(counts / 10 + 1)
+    weights = weights[codes]
+    return weights / weights.sum()
+
+
+class GroupWeightedSampler(WeightedRandomSampler):
+    def __init__(self, labels):
+        """
+        Draws as many cells as there are with replacement, weighted by the inverse log size of their class
+        :param labels: 1D array-like, class of each cell, e.g. clonotype
+        """
+        sampling_weights = calculate_sampling_weights(labels)
+        super(GroupWeightedSampler, self).__init__(weights=sampling_weights, num_samples=len(sampling_weights),
+                                                   replacement=True)
+
+    def to(self, device):
+        self.weights = self.weights.to(device)
+        return self
+
+    def sample_epoch(self):
+        """
+        Draw the cells of one epoch
+        :return: torch.LongTensor of indices on the device of the sampler
+        """
+        return torch.multinomial(self.weights, self.num_samples, self.replacement, generator=self.generator)
+
+
+class CappedGroupSampler(Sampler):
+    def __init__(self, labels, cap):
+        """
+        Draws at most cap cells of each class per epoch without replacement, e.g. to limit expanded clonotypes
+        :param labels: 1D array-like, class of each cell, e.g. clonotype
+        :param cap: int, maximum number of cells per class and epoch
+        """
+        codes, counts = encode_groups(labels)
+        self.cap = cap
+        self.num_samples = int(np.minimum(counts, cap).sum())
+        self.codes = torch.from_numpy(codes)
+        self.group_starts = torch.from_numpy(np.cumsum(counts) - counts)
+
+    def to(self, device):
+        self.codes = self.codes.to(device)
+        self.group_starts = self.group_starts.to(device)
+        return self
+
+    def __len__(self):
+        return self.num_samples
+
+    def sample_epoch(self):
+        """
+        Draw the cells of one epoch
+        :return: torch.LongTensor of shuffled indices on the device of the sampler
+        """
+        device = self.codes.device
+        num_cells = len(self.codes)
+        # adding uniform noise in [0, 1) to the codes groups the cells by class in random order within the class
+        order = torch.argsort(self.codes.double() + torch.rand(num_cells, device=device, dtype=torch.double))
+        rank = torch.arange(num_cells, device=device) - self.group_starts[self.codes[order]]
+        selected = order[rank < self.cap]
+        return selected[torch.randperm(len(selected), device=device)]
+
+    def __iter__(self):
+        return iter(self.sample_epoch().tolist())
+
+
+def create_balanced_sampler(labels, mode='weighted', cap=None):
+    """
+    Create a sampler balancing the classes of the cells
+    :param labels: 1D array-like, class of each cell, e.g. clonotype
+    :param mode: str, 'weighted': sampling with replacement weighted by the log class size,
+                      'capped': each class contributes at most cap cells per epoch without replacement
+    :param cap: int, only used for mode 'capped'
+    :return: torch Sampler yielding indices, with sample_epoch() to draw all indices of an epoch as tensor
+    """
+    if mode == 'weighted':
+        return GroupWeightedSampler(labels)
+    if mode == 'capped':
+        return CappedGroupSampler(labels, cap)
+    raise ValueError(f'Unknown sampling mode {mode}, please choose "weighted" or "capped".')
+
+
+def bucket_by_length(order, lengths, batch_size, bucket_batches):
+    """
+    Build batches of cells with similar sequence length, so the padding can be trimmed per batch
+    :param order: torch.LongTensor, indices of one epoch
+    :param lengths: torch.Tensor, sequence length for each index, on the same device as order
+    :param batch_size: int, batch size
+    :param bucket_batches: int, number of consecutive batches whose cells are sorted by length
+    :return: list of torch.LongTensor, the batches in random order
+    """
+    batches = []
+    for pool in order.split(batch_size * bucket_batches):
+        pool = pool[torch.argsort(lengths[pool])]
+        batches.extend(pool.split(batch_size))
+    permutation = torch.randperm(len(batches)).tolist()
+    return [batches[i] for i in permutation]
+
+
+class LengthBucketBatchSampler(Sampler):
+    def __init__(self, sampler, lengths, batch_size, bucket_batches=50):
+        """
+        Batch sampler grouping cells of similar sequence length, see bucket_by_length
+        :param sampler: torch Sampler yielding the indices of an epoch
+        :param lengths: torch.Tensor, sequence length of each cell
+        :param batch_size: int, batch size
+        :param bucket_batches: int, number of consecutive batches whose cells are sorted by length
+        """
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = torch.as_tensor(list(self.sampler), dtype=torch.long)
+        for batch in bucket_by_length(order, self.lengths, self.batch_size, self.bucket_batches):
+            yield batch.tolist()
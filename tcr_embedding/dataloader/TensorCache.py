@@ -0,0 +1,173 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import torch
+from scipy import sparse
+
+from tcr_embedding.dataloader.Dataset import SparseRnaData
+
+
+# increase when the layout of the cache changes, so old caches are not used anymore
+CACHE_VERSION = 6
+ARRAY_KEYS = ['tcr_seq', 'tcr_length', 'metadata', 'conditional', 'train_mask', 'sampling_labels', 'library_size']
+STORAGE_DTYPES = ['float32', 'float16', 'bfloat16']
+
+
+def update_hash(h, array):
+    array = np.ascontiguousarray(array)
+    h.update(f'{array.dtype}{array.shape}'.encode())
+    h.update(array.data)
+
+
+def hash_adata(adata, obs_columns, obsm_keys, settings, x=None):
+    """
+    Content hash of the parts of an in-memory adata the tensors are built from
+    :param adata: adata
+    :param obs_columns: list of str, columns of adata.obs used for the tensors
+    :param obsm_keys: list of str, keys of adata.obsm used for the tensors
+    :param settings: dict of JSON serializable settings that change the tensors
+    :param x: None or the gene expression matrix used for the tensors, e.g. adata.X
+    :return: str, hex digest
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps({'version': CACHE_VERSION, **settings}, sort_keys=True, default=str).encode())
+    h.update(str(adata.n_obs).encode())
+    if sparse.issparse(x):
+        x = sparse.csr_matrix(x)
+        h.update(str(x.shape).encode())
+        for array in [x.data, x.indices, x.indptr]:
+            update_hash(h, array)
+    elif x is not None:
+        update_hash(h, np.asarray(x))
+    for key in obsm_keys:
+        update_hash(h, np.asarray(adata.obsm[key]))
+    for column in obs_columns:
+        h.update(column.encode())
+        update_hash(h, pd.util.hash_pandas_object(adata.obs[column], index=False).to_numpy())
+    return h.hexdigest()
+
+
+def to_storage_dtype(array, dtype):
+    """
+    Convert values to the storage dtype of the files, numpy has no bfloat16, so its bits are stored as int16
+    :param array: np.array
+    :param dtype: str, one of STORAGE_DTYPES
+    :return: np.array
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f'Unknown storage dtype {dtype}, please choose one of {STORAGE_DTYPES}.')
+    if dtype == 'bfloat16':
+        return torch.from_numpy(np.asarray(array, dtype=np.float32)).to(torch.bfloat16).view(torch.int16).numpy()
+    return np.asarray(array, dtype=dtype)
+
+
+def from_storage_dtype(array, dtype):
+    """
+    Reverse to_storage_dtype without copying the values
+    :param array: np.array, e.g. memory-mapped
+    :param dtype: str, one of STORAGE_DTYPES
+    :return: np.array, torch.Tensor for bfloat16
+    """
+    if dtype == 'bfloat16':
+        return torch.from_numpy(array).view(torch.bfloat16)
+    return array
+
+
+def save_matrix(path, name, x, dtype='float32'):
+    """
+    Store a dense or sparse matrix as npy files
+    :param path: str, directory to store the files in
+    :param name: str, prefix of the files
+    :param x: None, np.array or scipy sparse matrix
+    :param dtype: str, storage dtype of the values, one of STORAGE_DTYPES
+    :return: dict describing the stored matrix for the manifest, see load_matrix
+    """
+    if x is None:
+        return {'format': None}
+    if sparse.issparse(x):
+        x = sparse.csr_matrix(x)
+        if not x.has_canonical_format:
+            x = x.copy()
+            x.sum_duplicates()
+        np.save(os.path.join(path, f'{name}_data.npy'), to_storage_dtype(x.data, dtype))
+        np.save(os.path.join(path, f'{name}_indices.npy'), x.indices.astype(np.int32, copy=False))
+        np.save(os.path.join(path, f'{name}_indptr.npy'), x.indptr.astype(np.int64, copy=False))
+        return {'format': 'sparse', 'shape': list(x.shape), 'dtype': dtype}
+    np.save(os.path.join(path, f'{name}.npy'), to_storage_dtype(x, dtype))
+    return {'format': 'dense', 'dtype': dtype}
+
+
+def load_matrix(path, name, info, sparse_format='rna_data'):
+    """
+    Memory-map a matrix stored by save_matrix
+    :param path: str, directory of the files
+    :param name: str, prefix of the files
+    :param info: dict returned by save_matrix
+    :param sparse_format: str, 'rna_data' returns sparse matrices as SparseRnaData, 'csr' as scipy csr_matrix,
+                          whose values are upcast to float32, as scipy has no 16 bit floats
+    :return: None, np.memmap, torch.Tensor (dense bfloat16), SparseRnaData or scipy csr_matrix
+    """
+    def load(suffix):
+        # copy-on-write, so torch can wrap the arrays without copying them
+        return np.load(os.path.join(path, f'{name}{suffix}.npy'), mmap_mode='c')
+
+    if info['format'] is None:
+        return None
+    # files written before the storage dtype was recorded hold float32
+    dtype = info['dtype'] if 'dtype' in info else 'float32'
+    if info['format'] == 'dense':
+        return from_storage_dtype(load(''), dtype)
+    data = torch.as_tensor(from_storage_dtype(load('_data'), dtype))
+    if sparse_format == 'csr':
+        return sparse.csr_matrix((data.float().numpy(), load('_indices'), load('_indptr')),
+                                 shape=tuple(info['shape']), copy=False)
+    return SparseRnaData.from_arrays(data, load('_indices'), load('_indptr'), tuple(info['shape']), data.dtype)
+
+
+def save_tensors(path, tensors, rna_dtype='float32'):
+    """
+    Store the encoded tensors as npy files with a JSON manifest
+    :param path: str, directory of this cache entry, it is written under a temporary name and renamed at the end,
+                 so concurrent runs never read a partial entry
+    :param tensors: dict with rna (None, np.array or scipy sparse matrix), metadata_categories and the ARRAY_KEYS
+    :param rna_dtype: str, storage dtype of the gene expression, see params_loader['rna_dtype']
+    """
+    path_tmp = f'{path}.tmp{os.getpid()}'
+    os.makedirs(path_tmp, exist_ok=True)
+    manifest = {'arrays': [key for key in ARRAY_KEYS if tensors[key] is not None],
+                'metadata_categories': [[str(c) for c in categories] for categories in tensors['metadata_categories']]}
+
+    manifest['rna'] = save_matrix(path_tmp, 'rna', tensors['rna'], rna_dtype)
+
+    for key in manifest['arrays']:
+        np.save(os.path.join(path_tmp, f'{key}.npy'), np.asarray(tensors[key]))
+    with open(os.path.join(path_tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    try:
+        os.replace(path_tmp, path)
+    except OSError:
+        # another run stored the same entry in the meantime
+        shutil.rmtree(path_tmp)
+
+
+def load_tensors(path):
+    """
+    Memory-map the tensors of a cache entry, pages are only read when they are used and shared between processes
+    :param path: str, directory of the cache entry
+    :return: dict with the same keys as for save_tensors, rna is already a SparseRnaData for sparse data
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    def load(name):
+        # copy-on-write, so torch can wrap the arrays without copying them
+        return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c')
+
+    tensors = {key: load(key) if key in manifest['arrays'] else None for key in ARRAY_KEYS}
+    tensors['rna'] = load_matrix(path, 'rna', manifest['rna'])
+    tensors['metadata_categories'] = [np.asarray(categories) for categories in manifest['metadata_categories']]
+    return tensors
@@ -48,7 +48,6 @@ class CNNEncoder(nn.Module):
 		self.use_embedding_matrix = use_embedding_matrix
 		self.num_seq_labels = num_seq_labels
 		if use_embedding_matrix:
-			self.one_hot = nn.functional.one_hot
 			self.embedding = nn.Parameter(torch.randn(num_seq_labels, params['embedding_dim']))
 		else:
 			self.embedding = nn.Embedding(num_embeddings=num_seq_labels, embedding_dim=params['embedding_dim'], padding_idx=0)
@@ -78,7 +77,8 @@ class CNNEncoder(nn.Module):
 
 	def forward(self, tcr_seq, tcr_len):
 		if self.use_embedding_matrix:
-			x = torch.matmul(self.one_hot(tcr_seq, self.num_seq_labels).float(), self.embedding)
+			# same as one_hot(tcr_seq) @ embedding, but gathers the rows instead of building the one-hot tensor
+			x = nn.functional.embedding(tcr_seq, self.embedding)
 		else:
 			x = self.embedding(tcr_seq)  # shape=[batch, sequence, feature]
 		x = x.permute(0, 2, 1)  # shape=[batch, feature, sequence]
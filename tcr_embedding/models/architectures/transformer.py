@@ -1,6 +1,14 @@
 import math
+import inspect
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+# torch>=2.0 checks the values of the target mask on every call unless it is marked as causal, the check reads the
+# mask back to the host and breaks the graph of compiled models
+DECODER_CAUSAL_KWARGS = {'tgt_is_causal': True} \
+    if 'tgt_is_causal' in inspect.signature(nn.TransformerDecoder.forward).parameters else {}
 
 
 # from https://pytorch.org/tutorials/beginner/transformer_tutorial.html
@@ -36,6 +44,9 @@ class TransformerEncoder(nn.Module):
         """
         super(TransformerEncoder, self).__init__()
         self.params = params
+        # variable_length: mask the padding and pool over the real positions, so batches can be trimmed to their
+        # longest sequence, else the flattened padded sequence is used
+        self.variable_length = 'variable_length' in params and params['variable_length']
 
         self.num_seq_labels = num_seq_labels
 
@@ -50,15 +61,30 @@ class TransformerEncoder(nn.Module):
                                                      params['dropout'])
         self.transformer_encoder = nn.TransformerEncoder(encoding_layers, params['encoding_layers'])
 
-        self.fc_reduction = nn.Linear(params['max_tcr_length'] * params['embedding_size'], hdim)
+        if self.variable_length:
+            self.fc_reduction = nn.Linear(params['embedding_size'], hdim)
+        else:
+            self.fc_reduction = nn.Linear(params['max_tcr_length'] * params['embedding_size'], hdim)
 
     def forward(self, x, tcr_len):
+        if self.variable_length:
+            padding_mask = x == 0
+            # keep the first position, attention over fully masked (empty) sequences results in NaN
+            padding_mask[:, 0] = False
+
         x = self.embedding(x) * math.sqrt(self.num_seq_labels)
         x = x.transpose(0, 1)
         x = x + self.positional_encoding(x)
-        x = self.transformer_encoder(x)
-        x = x.transpose(0, 1)
-        x = x.flatten(1)
+        if self.variable_length:
+            x = self.transformer_encoder(x, src_key_padding_mask=padding_mask)
+            x = x.transpose(0, 1)
+            # mean over the non-padded positions, shape=[batch_size, embedding_size]
+            non_padded = (~padding_mask).unsqueeze(-1).to(x.dtype)
+            x = (x * non_padded).sum(dim=1) / non_padded.sum(dim=1)
+        else:
+            x = self.transformer_encoder(x)
+            x = x.transpose(0, 1)
+            x = x.flatten(1)
         x = self.fc_reduction(x)
         return x
 
@@ -101,8 +127,12 @@ class TransformerDecoder(nn.Module):
         :param target_sequence: Ground truth output
         :return:
         """
-        hidden_state = self.fc_upsample(hidden_state)
-        shape = (hidden_state.shape[0], self.params['max_tcr_length'], self.params['embedding_size'])
+        # only upsample to the positions of the target sequence, which can be trimmed to the longest sequence of the batch
+        seq_len = target_sequence.shape[1]
+        num_features = seq_len * self.params['embedding_size']
+        hidden_state = F.linear(hidden_state, self.fc_upsample.weight[:num_features],
+                                self.fc_upsample.bias[:num_features])
+        shape = (hidden_state.shape[0], seq_len, self.params['embedding_size'])
         hidden_state = torch.reshape(hidden_state, shape)
 
         hidden_state = hidden_state.transpose(0, 1)
@@ -112,11 +142,11 @@ class TransformerDecoder(nn.Module):
 
         target_sequence = self.embedding(target_sequence) * math.sqrt(self.num_seq_labels)
         target_sequence = target_sequence + self.positional_encoding(target_sequence)
-        try:
-            target_mask = nn.Transformer.generate_square_subsequent_mask(None, target_sequence.shape[0]).to(self.device)
-        except:  # new version don't need the None
-            target_mask = nn.Transformer.generate_square_subsequent_mask(target_sequence.shape[0]).to(self.device)
-        x = self.transformer_decoder(target_sequence, hidden_state, tgt_mask=target_mask)
+        # same mask as nn.Transformer.generate_square_subsequent_mask, whose signature differs between torch versions
+        seq_len = target_sequence.shape[0]
+        target_mask = torch.triu(torch.full((seq_len, seq_len), float('-inf'), device=target_sequence.device),
+                                 diagonal=1)
+        x = self.transformer_decoder(target_sequence, hidden_state, tgt_mask=target_mask, **DECODER_CAUSAL_KWARGS)
         x = self.fc_out(x)
         x = x.transpose(0, 1)
         return x
@@ -20,10 +20,12 @@ class KLD(torch.nn.Module):
         :param logvar_2: log(var) of the second Gaussian (default: 1)
         :return: loss value
         """
+        # exp(logvar) overflows easily in reduced precision
+        mu, logvar = mu.float(), logvar.float()
         if mu_2 is None or logvar_2 is None:
             kl = self.univariate_kl_loss(mu, logvar)
         else:
-            kl = self.general_kl_loss(mu, logvar, mu_2, logvar_2)
+            kl = self.general_kl_loss(mu, logvar, mu_2.float(), logvar_2.float())
         if self.reduction == 'mean':
             kl = torch.mean(kl)
         elif self.reduction == 'sum':
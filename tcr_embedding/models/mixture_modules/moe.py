@@ -7,6 +7,7 @@ from tcr_embedding.models.architectures.transformer import TransformerEncoder, T
 from tcr_embedding.models.architectures.mlp import MLP
 from tcr_embedding.models.architectures.mlp_scRNA import build_mlp_encoder, build_mlp_decoder
 from tcr_embedding.models.vae_base_model import VAEBaseModel
+from tcr_embedding.dataloader.DataLoader import count_conditional_labels
 from tcr_embedding.dataloader.DataLoader import initialize_prediction_loader
 
 
@@ -181,18 +182,16 @@ class MoEModel(VAEBaseModel):
 									   conditional, optimization_mode_params, label_key, device)
 		self.model_type = 'moe'
 
-		self.params_tcr['max_tcr_length'] = adata.obsm['alpha_seq'].shape[1]
+		self.params_tcr['max_tcr_length'] = self.adata.obsm['alpha_seq'].shape[1]
 		self.params_tcr['num_seq_labels'] = len(self.aa_to_id)
 
-		self.params_rna['xdim'] = adata[0].X.shape[1]
+		self.params_rna['xdim'] = self.adata.n_vars
 
 		num_conditional_labels = 0
 		cond_dim = 0
 		if self.conditional is not None:
-			if self.conditional in adata.obsm:
-				num_conditional_labels = adata.obsm[self.conditional].shape[1]
-			else:
-				num_conditional_labels = len(adata.obs[self.conditional].unique())
+			num_conditional_labels = count_conditional_labels(self.adata, self.conditional,
+															  self.params_loader['conditional_categories'])
 			if 'c_embedding_dim' not in self.params_joint:
 				cond_dim = 20
 			else:
@@ -237,21 +236,23 @@ class MoEModel(VAEBaseModel):
 		:param return_mean: bool, calculate latent space without sampling
 		:return: adata containing embedding vector in adata.X for each cell and the specified metadata in adata.obs
 		"""
-		data_embed = initialize_prediction_loader(adata, metadata, self.batch_size, beta_only=self.beta_only)
+		data_embed = initialize_prediction_loader(adata, metadata, self.batch_size, beta_only=self.beta_only,
+												  params_loader=self.params_loader)
 
 		zs = []
 		with torch.no_grad():
 			self.model = self.model.to(self.device)
 			self.model.eval()
-			for rna, tcr, seq_len, _, labels, conditional in data_embed:
-				rna = rna.to(self.device)
-				tcr = tcr.to(self.device)
+			for rna, tcr, seq_len, _, labels, conditional in self.prefetch(data_embed):
+				rna = rna.to(self.device).float()
+				tcr = tcr.to(self.device).long()
+				seq_len = seq_len.long()
 
 				if self.conditional is not None:
 					conditional = conditional.to(self.device)
 				else:
 					conditional = None
-				z, mu, _, _, _ = self.model(rna, tcr, seq_len, conditional)
+				z, mu, _, _, _ = self.forward_model(rna, tcr, seq_len, conditional)
 				if return_mean:
 					z = mu
 				if modality == 'RNA':
@@ -6,6 +6,7 @@ from tcr_embedding.models.architectures.transformer import TransformerEncoder, T
 from tcr_embedding.models.architectures.mlp import MLP
 from tcr_embedding.models.architectures.mlp_scRNA import build_mlp_encoder, build_mlp_decoder
 from tcr_embedding.models.vae_base_model import VAEBaseModel
+from tcr_embedding.dataloader.DataLoader import count_conditional_labels
 
 
 class PoEModelTorch(nn.Module):
@@ -133,14 +134,16 @@ class PoEModelTorch(nn.Module):
         return z
 
     def product_of_experts(self, mu_rna, mu_tcr, logvar_rna, logvar_tcr):
-        # formula: var_joint = inv(inv(var_prior) + sum(inv(var_modalities)))
-        logvar_joint = 1.0 / torch.exp(logvar_rna) + 1.0 / torch.exp(
-            logvar_tcr) + 1.0  # sum up all inverse vars, logvars first needs to be converted to var, last 1.0 is coming from the prior
-        logvar_joint = torch.log(1.0 / logvar_joint)  # inverse and convert to logvar
+        # in float32, also when the forward pass runs in reduced precision
+        mu_rna, mu_tcr, logvar_rna, logvar_tcr = [x.float() for x in [mu_rna, mu_tcr, logvar_rna, logvar_tcr]]
+
+        # formula: var_joint = inv(inv(var_prior) + sum(inv(var_modalities))), where logvar_prior = 0.0
+        # as log-sum-exp of the negative logvars, so small variances don't overflow the inverse
+        logvar_joint = -torch.logsumexp(torch.stack([torch.zeros_like(logvar_rna), -logvar_rna, -logvar_tcr]), dim=0)
 
         # formula: mu_joint = (mu_prior*inv(var_prior) + sum(mu_modalities*inv(var_modalities))) * var_joint, where mu_prior = 0.0
-        mu_joint = mu_rna * (1.0 / torch.exp(logvar_rna)) + mu_tcr * (1.0 / torch.exp(logvar_tcr))
-        mu_joint = mu_joint * torch.exp(logvar_joint)
+        # var_joint / var_modality <= 1, so the factors can't overflow either
+        mu_joint = mu_rna * torch.exp(logvar_joint - logvar_rna) + mu_tcr * torch.exp(logvar_joint - logvar_tcr)
 
         return mu_joint, logvar_joint
 
@@ -178,18 +181,16 @@ class PoEModel(VAEBaseModel):
 
         self.model_type = 'poe'
 
-        self.params_tcr['max_tcr_length'] = adata.obsm['alpha_seq'].shape[1]
+        self.params_tcr['max_tcr_length'] = self.adata.obsm['alpha_seq'].shape[1]
         self.params_tcr['num_seq_labels'] = len(self.aa_to_id)
 
-        self.params_rna['xdim'] = adata[0].X.shape[1]
+        self.params_rna['xdim'] = self.adata.n_vars
 
         num_conditional_labels = 0
         cond_dim = 0
         if self.conditional is not None:
-            if self.conditional in adata.obsm:
-                num_conditional_labels = adata.obsm[self.conditional].shape[1]
-            else:
-                num_conditional_labels = len(adata.obs[self.conditional].unique())
+            num_conditional_labels = count_conditional_labels(self.adata, self.conditional,
+                                                              self.params_loader['conditional_categories'])
             if 'c_embedding_dim' not in self.params_joint:
                 cond_dim = 20
             else:
@@ -4,6 +4,7 @@ import torch.nn as nn
 from tcr_embedding.models.architectures.mlp import MLP
 from tcr_embedding.models.architectures.mlp_scRNA import build_mlp_encoder, build_mlp_decoder
 from tcr_embedding.models.vae_base_model import VAEBaseModel
+from tcr_embedding.dataloader.DataLoader import count_conditional_labels
 
 
 def none_model(hyperparams, hdim, xdim):
@@ -115,15 +116,13 @@ class RnaModel(VAEBaseModel):
 									   conditional, optimization_mode_params, label_key, device)
 		self.model_type = 'rna'
 
-		self.params_rna['xdim'] = adata[0].X.shape[1]
+		self.params_rna['xdim'] = self.adata.n_vars
 
 		num_conditional_labels = 0
 		cond_dim = 0
 		if self.conditional is not None:
-			if self.conditional in adata.obsm:
-				num_conditional_labels = adata.obsm[self.conditional].shape[1]
-			else:
-				num_conditional_labels = len(adata.obs[self.conditional].unique())
+			num_conditional_labels = count_conditional_labels(self.adata, self.conditional,
+															  self.params_loader['conditional_categories'])
 			if 'c_embedding_dim' not in self.params_joint:
 				cond_dim = 20
 			else:
@@ -136,7 +135,7 @@ class RnaModel(VAEBaseModel):
 
 	def calculate_loss(self, rna_pred, rna, tcr_pred, tcr):
 		rna_loss = self.loss_weights[0] * self.loss_function_rna(rna_pred, rna)
-		tcr_loss = torch.FloatTensor([0]).to(self.device)
+		tcr_loss = torch.zeros(1, device=self.device)
 		return rna_loss, tcr_loss
 
 	def calculate_kld_loss(self, mu, logvar, epoch):
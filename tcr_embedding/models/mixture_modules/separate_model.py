@@ -5,6 +5,7 @@ from tcr_embedding.models.architectures.transformer import TransformerEncoder, T
 from tcr_embedding.models.architectures.mlp import MLP
 from tcr_embedding.models.architectures.mlp_scRNA import build_mlp_encoder, build_mlp_decoder
 from tcr_embedding.models.vae_base_model import VAEBaseModel
+from tcr_embedding.dataloader.DataLoader import count_conditional_labels
 
 
 def none_model(hyperparams, hdim, xdim):
@@ -158,19 +159,17 @@ class SeparateModel(VAEBaseModel):
 											conditional, optimization_mode_params, label_key, device)
 		self.model_type = 'separate'
 
-		self.params_tcr['max_tcr_length'] = adata.obsm['alpha_seq'].shape[1]
+		self.params_tcr['max_tcr_length'] = self.adata.obsm['alpha_seq'].shape[1]
 		self.params_tcr['num_seq_labels'] = len(self.aa_to_id)
 
 		if self.params_rna is not None:
-			self.params_rna['xdim'] = adata[0].X.shape[1]
+			self.params_rna['xdim'] = self.adata.n_vars
 
 		num_conditional_labels = 0
 		cond_dim = 0
 		if self.conditional is not None:
-			if self.conditional in adata.obsm:
-				num_conditional_labels = adata.obsm[self.conditional].shape[1]
-			else:
-				num_conditional_labels = len(adata.obs[self.conditional].unique())
+			num_conditional_labels = count_conditional_labels(self.adata, self.conditional,
+															  self.params_loader['conditional_categories'])
 			if 'c_embedding_dim' not in self.params_joint:
 				cond_dim = 20
 			else:
@@ -190,7 +189,7 @@ class SeparateModel(VAEBaseModel):
 		else:  # For CNN, as it predicts start token
 			tcr_loss = self.loss_weights[1] * self.loss_function_tcr(tcr_pred.flatten(end_dim=1), tcr.flatten())
 
-		rna_loss = torch.FloatTensor([0]).to(self.device)
+		rna_loss = torch.zeros(1, device=self.device)
 		if rna_pred is not None:
 			rna_loss = self.loss_weights[0] * self.loss_function_rna(rna_pred, rna)
 		return rna_loss, tcr_loss
@@ -73,7 +73,8 @@ def fail_save(func):
 
 #@fail_save
 def objective(trial, adata_tmp, suggest_params, params_experiment_base, optimization_mode_params):
-    adata = adata_tmp.copy()
+    # the data itself is not modified during training, so all trials share the same adata instead of a copy each
+    adata = adata_tmp
     params_experiment = params_experiment_base.copy()
     params_experiment = complete_params_experiment(params_experiment)
     params_experiment['save_path'] = os.path.join(params_experiment['save_path'], f'trial_{trial.number}')
@@ -87,6 +88,10 @@ def objective(trial, adata_tmp, suggest_params, params_experiment_base, optimiza
         rna_weight = optimization_mode_params['rna_weight']
         params_architecture['loss_weights'] = params_architecture['loss_weights'].append(rna_weight)
 
+    if 'loader' in params_experiment:
+        # e.g. a shared cache_dir, so the encoded tensors are built once for all trials
+        params_architecture['loader'] = dict(params_experiment['loader'])
+
     if 'use_embedding_for_cond' in params_experiment:
         params_architecture['joint']['use_embedding_for_cond'] = params_experiment['use_embedding_for_cond']
     # if 'cond_input' in params_experiment:
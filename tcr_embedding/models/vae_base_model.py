@@ -5,6 +5,8 @@ warnings.filterwarnings('ignore')  # "error", "ignore", "always", "default", "mo
 import torch
 import torch.nn as nn
 import os
+import contextlib
+import math
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -15,13 +17,33 @@ from abc import ABC, abstractmethod
 from .losses.kld import KLD
 
 from tcr_embedding.dataloader.DataLoader import initialize_data_loader, initialize_latent_loader
-from tcr_embedding.dataloader.DataLoader import initialize_prediction_loader
+from tcr_embedding.dataloader.DataLoader import initialize_prediction_loader, complete_params_loader, check_rna_dtype
+from tcr_embedding.dataloader.DataLoader import BatchPrefetcher, get_conditional_categories
+from tcr_embedding.dataloader.Bundle import TrainingBundle
 
 from .optimization.knn_prediction import report_knn_prediction
 from .optimization.modulation_prediction import report_modulation_prediction
 from .optimization.pseudo_metric import report_pseudo_metric
 
 
+PRECISIONS = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+# loader parameters determined from the training data, they are saved with the model, see VAEBaseModel.save
+LEARNED_LOADER_PARAMS = ['target_sum', 'conditional_categories']
+
+
+def to_float32(outputs):
+	"""
+	Cast the outputs of a forward pass in reduced precision back to float32, e.g. for the losses
+	:param outputs: tensor or (nested) list or tuple of tensors
+	:return: same structure with float32 tensors
+	"""
+	if isinstance(outputs, (list, tuple)):
+		return type(outputs)(to_float32(output) for output in outputs)
+	if torch.is_tensor(outputs) and outputs.is_floating_point():
+		return outputs.float()
+	return outputs
+
+
 class VAEBaseModel(ABC):
 	def __init__(self,
 				 adata,
@@ -34,12 +56,14 @@ class VAEBaseModel(ABC):
 				 device=None):
 		"""
 		VAE Base Model, used for both single and joint models
-		:param adata: list of adatas containing train and val set
-		:param conditional: str or None, if None a normal VAE is used, if str then the str determines the adata.obsm[conditional] as conditioning variable
+		:param adata: adata containing train and val set, or the path of a bundle written by export_bundle
+		:param conditional: str or None, if None a normal VAE is used, if str then the str determines the adata.obsm[conditional] (one-hot) or the column adata.obs[conditional] as conditioning variable
 		:param metadata: list of str, list of metadata that is needed, not really useful at the moment
 		:param balanced_sampling: None or str, indicate adata.obs column to balance
 		:param optimization_mode_params: dict carrying the mode specific parameters
 		"""
+		if isinstance(adata, str):
+			adata = TrainingBundle(adata)
 		self.adata = adata
 		self.params_architecture = params_architecture
 		self.balanced_sampling = balanced_sampling
@@ -63,6 +87,14 @@ class VAEBaseModel(ABC):
 			self.params_rna = params_architecture['rna']
 		if 'supervised' in params_architecture:
 			self.params_supervised = params_architecture['supervised']
+		self.params_loader = complete_params_loader(params_architecture['loader'] if 'loader' in params_architecture
+													else None)
+		if self.params_tcr is not None and 'variable_length' in self.params_tcr and self.params_tcr['variable_length']:
+			# the padding-aware transformers allow to cut each batch to its longest CDR3 sequence
+			self.params_loader['trim_tcr'] = True
+		# the data layer skips the modalities the model doesn't use
+		self.params_loader['use_rna'] = self.params_rna is not None
+		self.params_loader['use_tcr'] = self.params_tcr is not None
 
 		if self.params_tcr is None and self.params_rna is None:
 			raise ValueError('Please specify either tcr, rna, or both hyperparameters.')
@@ -71,6 +103,24 @@ class VAEBaseModel(ABC):
 
 		if self.device is None:
 			self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+		self.device = torch.device(self.device)
+
+		# precision of the forward passes, weights, optimizer and losses stay in float32
+		self.precision = params_architecture['precision'] if 'precision' in params_architecture else 'float32'
+		if self.precision not in PRECISIONS:
+			raise ValueError(f'Unknown precision {self.precision}, please use one of {list(PRECISIONS)}.')
+		if self.precision == 'float16' and self.device.type != 'cuda':
+			raise ValueError('float16 needs a CUDA device, please use bfloat16 on the CPU.')
+		self.scaler = None
+
+		# backend of torch.compile for the forward passes, True uses inductor, which also generates kernels for the CPU
+		compile_backend = params_architecture['compile'] if 'compile' in params_architecture else False
+		if compile_backend is True:
+			compile_backend = 'inductor'
+		self.compile_backend = compile_backend or None
+		if self.compile_backend is not None and not hasattr(torch, 'compile'):
+			raise ValueError('Compiling the model needs torch>=2.0, please remove params_architecture["compile"].')
+		self._compiled_model = None
 
 		self._train_history = defaultdict(list)
 		self._val_history = defaultdict(list)
@@ -106,19 +156,36 @@ class VAEBaseModel(ABC):
 			metadata = []
 		if balanced_sampling is not None and balanced_sampling not in metadata:
 			metadata.append(balanced_sampling)
+		if conditional is not None and self.params_loader['conditional_categories'] is None:
+			# the labels of the training data fix the codes, subsets and new data are encoded with the same codes
+			self.params_loader['conditional_categories'] = get_conditional_categories(adata, conditional)
 		self.data_train, self.data_val = initialize_data_loader(adata, metadata, conditional, label_key,
 																balanced_sampling, self.batch_size,
-																beta_only=self.beta_only)
+																beta_only=self.beta_only,
+																params_loader=self.params_loader,
+																device=self.device)
+		if self.params_loader['normalize_counts'] and self.params_loader['target_sum'] is None:
+			# keep the target of the training data, so predictions and reloaded models normalize the same way
+			self.params_loader['target_sum'] = self.data_train.dataset.target_sum
 
 	def change_adata(self, new_adata):
+		if isinstance(new_adata, str):
+			new_adata = TrainingBundle(new_adata)
 		self.adata = new_adata
 		self.aa_to_id = new_adata.uns['aa_to_id']
 		if self.balanced_sampling is not None and self.balanced_sampling not in self.metadata:
 			self.metadata.append(self.balanced_sampling)
+		if self.conditional is not None and self.params_loader['conditional_categories'] is not None:
+			# new labels get the next codes, their embeddings are added with add_new_embeddings
+			categories = self.params_loader['conditional_categories']
+			new_categories = get_conditional_categories(new_adata, self.conditional)
+			self.params_loader['conditional_categories'] = categories + [c for c in new_categories if c not in categories]
 
 		self.data_train, self.data_val = initialize_data_loader(new_adata, self.metadata, self.conditional, self.label_key,
 																self.balanced_sampling, self.batch_size,
-																beta_only=self.beta_only)
+																beta_only=self.beta_only,
+																params_loader=self.params_loader,
+																device=self.device)
 
 	def add_new_embeddings(self, num_new_embeddings):
 		cond_emb_tmp = self.model.cond_emb.weight.data
@@ -165,6 +232,8 @@ class VAEBaseModel(ABC):
 		self.comet = comet
 		self.kl_annealing_epochs = kl_annealing_epochs
 		assert 3 <= len(loss_weights) <= 4, 'Length of loss weights need to be either 3 or 4.'
+		# predictions may use data of any dtype, the training data needs to be stored compactly
+		check_rna_dtype(self.data_train.dataset, self.params_loader)
 
 		try:
 			os.makedirs(save_path)  # Create directory to prevent Error while saving model weights
@@ -178,6 +247,8 @@ class VAEBaseModel(ABC):
 
 		self.model = self.model.to(self.device)
 		self.optimizer = torch.optim.Adam(params=self.model.parameters(), lr=learning_rate)
+		# small float16 gradients would underflow without scaling the loss, bfloat16 has the range of float32
+		self.scaler = torch.cuda.amp.GradScaler() if self.precision == 'float16' else None
 
 		for epoch in tqdm(range(n_epochs)):
 			self.model.train()
@@ -198,25 +269,27 @@ class VAEBaseModel(ABC):
 			data = self.data_train
 		else:
 			data = self.data_val
-		loss_total = []
-		rna_loss_total = []
-		tcr_loss_total = []
-		kld_loss_total = []
-		cls_loss_total = []
+		# detached running sums on the device: the graphs of past batches are freed and the device is only
+		# synchronized once per epoch. A NaN loss propagates into the sums and is reported at the end of the epoch.
+		loss_sums = torch.zeros(4, device=self.device)
+		cls_loss_sum = torch.zeros(1, device=self.device)
 		cls_acc_total = []
+		num_batches = 0
 
-		for rna, tcr, seq_len, _, labels, conditional in data:
+		for rna, tcr, seq_len, _, labels, conditional in self.prefetch(data):
 			if rna.shape[0] == 1 and phase == 'train':
 				continue  # BatchNorm cannot handle batches of size 1 during training phase
-			rna = rna.to(self.device)
-			tcr = tcr.to(self.device)
+			rna = rna.to(self.device).float()  # upcast from the storage dtype, see params_loader['rna_dtype']
+			# tokens and lengths are stored as uint8, the embeddings and losses need int64
+			tcr = tcr.to(self.device).long()
+			seq_len = seq_len.long()
 
 			if self.conditional is not None:
 				conditional = conditional.to(self.device)
 			else:
 				conditional = None
 
-			z, mu, logvar, rna_pred, tcr_pred = self.model(rna, tcr, seq_len, conditional)
+			z, mu, logvar, rna_pred, tcr_pred = self.forward_model(rna, tcr, seq_len, conditional)
 			kld_loss, z = self.calculate_kld_loss(mu, logvar, epoch)
 			rna_loss, tcr_loss = self.calculate_loss(rna_pred, rna, tcr_pred, tcr)
 			loss = kld_loss + rna_loss + tcr_loss
@@ -226,25 +299,20 @@ class VAEBaseModel(ABC):
 				cls_acc = torch.sum(torch.eq(prediction_label, labels))
 				cls_loss = self.calculate_classification_loss(prediction_label, labels)
 				loss += cls_loss
-				cls_loss_total.append(cls_loss)
+				cls_loss_sum += cls_loss.detach()
 				cls_acc_total.append(cls_acc)
 
 			if phase == 'train':
 				self.run_backward_pass(loss)
 
-			loss_total.append(loss)
-			rna_loss_total.append(rna_loss)
-			tcr_loss_total.append(tcr_loss)
-			kld_loss_total.append(kld_loss)
-
-			if torch.isnan(loss):
-				print(f'ERROR: NaN in loss.')
-				return
+			loss_sums += torch.cat([value.detach().reshape(1) for value in [loss, rna_loss, tcr_loss, kld_loss]])
+			num_batches += 1
 
-		loss_total = torch.stack(loss_total).mean().item()
-		rna_loss_total = torch.stack(rna_loss_total).mean().item()
-		tcr_loss_total = torch.stack(tcr_loss_total).mean().item()
-		kld_loss_total = torch.stack(kld_loss_total).mean().item()
+		# the only transfer to the host in this epoch
+		loss_total, rna_loss_total, tcr_loss_total, kld_loss_total = (loss_sums / num_batches).tolist()
+		if math.isnan(loss_total):
+			print(f'ERROR: NaN in loss.')
+			return
 
 		summary_losses = {f'{phase} Loss': loss_total,
 						  f'{phase} RNA Loss': rna_loss_total,
@@ -252,22 +320,70 @@ class VAEBaseModel(ABC):
 						  f'{phase} KLD Loss': kld_loss_total}
 
 		if self.supervised_model is not None:
-			cls_loss_total = torch.stack(cls_loss_total).mean().item()
-			summary_losses[f'{phase} CLS Loss'] = cls_loss_total
+			summary_losses[f'{phase} CLS Loss'] = cls_loss_sum.item() / num_batches
 			summary_losses[f'{phase} CLS Accuracy'] = cls_acc_total
 
 		return summary_losses
 
+	def prefetch(self, loader):
+		"""
+		Wrap the loader to prepare batches in the background, if params_loader['prefetch_batches'] is set
+		:param loader: iterable over batches
+		:return: iterable over batches
+		"""
+		if self.params_loader['prefetch_batches'] > 0:
+			return BatchPrefetcher(loader, self.params_loader['prefetch_batches'])
+		return loader
+
+	def autocast(self):
+		"""
+		Context for running forward passes in the precision of params_architecture['precision']
+		:return: context manager
+		"""
+		if self.precision == 'float32':
+			return contextlib.nullcontext()
+		return torch.autocast(device_type=self.device.type, dtype=PRECISIONS[self.precision])
+
+	def forward_model(self, rna, tcr, seq_len, conditional):
+		"""
+		Forward pass of self.model in the precision of the model, compiled if params_architecture['compile'] is set
+		:return: outputs of the forward pass, floating point tensors in float32
+		"""
+		model = self.model if self.compile_backend is None else self.get_compiled_model()
+		with self.autocast():
+			return to_float32(model(rna, tcr, seq_len, conditional))
+
+	def get_compiled_model(self):
+		"""
+		The compiled module shares the parameters with self.model, it is rebuilt when self.model is replaced
+		Batch sizes and trimmed sequence lengths that differ from the first batch trigger one recompilation
+		with dynamic shapes.
+		:return: torch.compile wrapper of self.model
+		"""
+		if self._compiled_model is None or self._compiled_model._orig_mod is not self.model:
+			self._compiled_model = torch.compile(self.model, backend=self.compile_backend)
+		return self._compiled_model
+
 	def log_losses(self, summary_losses, epoch):
 		if self.comet is not None:
 			self.comet.log_metrics(summary_losses, epoch=epoch)
 
 	def run_backward_pass(self, loss):
 		self.optimizer.zero_grad()
-		loss.backward()
+		if self.scaler is None:
+			loss.backward()
+		else:
+			self.scaler.scale(loss).backward()
+			# clip the actual gradients
+			self.scaler.unscale_(self.optimizer)
 		if self.optimization_mode_params is not None and 'grad_clip' in self.optimization_mode_params:
 			nn.utils.clip_grad_value_(self.model.parameters(), self.optimization_mode_params['grad_clip'])
-		self.optimizer.step()
+		if self.scaler is None:
+			self.optimizer.step()
+		else:
+			# skips the step if the scaled gradients overflowed
+			self.scaler.step(self.optimizer)
+			self.scaler.update()
 
 	def additional_evaluation(self, epoch, save_path):
 		if self.optimization_mode_params is None:
@@ -316,21 +432,22 @@ class VAEBaseModel(ABC):
 		:return: adata containing embedding vector in adata.X for each cell and the specified metadata in adata.obs
 		"""
 		data_embed = initialize_prediction_loader(adata, metadata, self.batch_size, beta_only=self.beta_only,
-												  conditional=self.conditional)
+												  conditional=self.conditional, params_loader=self.params_loader)
 
 		zs = []
 		with torch.no_grad():
 			self.model = self.model.to(self.device)
 			self.model.eval()
-			for rna, tcr, seq_len, _, labels, conditional in data_embed:
-				rna = rna.to(self.device)
-				tcr = tcr.to(self.device)
+			for rna, tcr, seq_len, _, labels, conditional in self.prefetch(data_embed):
+				rna = rna.to(self.device).float()
+				tcr = tcr.to(self.device).long()
+				seq_len = seq_len.long()
 
 				if self.conditional is not None:
 					conditional = conditional.to(self.device)
 				else:
 					conditional = None
-				z, mu, _, _, _ = self.model(rna, tcr, seq_len, conditional)
+				z, mu, _, _, _ = self.forward_model(rna, tcr, seq_len, conditional)
 				if return_mean:
 					z = mu
 				z = self.model.get_latent_from_z(z)
@@ -343,19 +460,21 @@ class VAEBaseModel(ABC):
 		return latent
 
 	def predict_rna_from_latent(self, adata_latent, metadata=None):
-		data = initialize_latent_loader(adata_latent, self.batch_size, self.conditional)
+		data = initialize_latent_loader(adata_latent, self.batch_size, self.conditional,
+										self.params_loader['conditional_categories'])
 		rnas = []
 		with torch.no_grad():
 			model = self.model.to(self.device)
 			model.eval()
-			for batch in data:
+			for batch in self.prefetch(data):
 				if self.conditional is not None:
-					batch = batch[0].to(self.device)
 					conditional = batch[1].to(self.device)
+					batch = batch[0].to(self.device)
 				else:
 					batch = batch[0].to(self.device)
 					conditional = None
-				batch_rna = model.predict_transcriptome(batch, conditional)
+				with self.autocast():
+					batch_rna = model.predict_transcriptome(batch, conditional).float()
 				batch_rna = sc.AnnData(batch_rna.detach().cpu().numpy())
 				rnas.append(batch_rna)
 		rnas = sc.AnnData.concatenate(*rnas)
@@ -366,12 +485,14 @@ class VAEBaseModel(ABC):
 
 	def predict_label(self, adata):
 		data, _ = initialize_data_loader(adata, None, self.conditional, self.label_key,
-										 None, self.batch_size, beta_only=self.beta_only)
+										 None, self.batch_size, beta_only=self.beta_only,
+										 params_loader=self.params_loader, device=self.device)
 		prediction_total = []
 		with torch.no_grad():
 			for rna, tcr, seq_len, metadata_batch, labels, conditional in data:
-				rna = rna.to(self.device)
-				tcr = tcr.to(self.device)
+				rna = rna.to(self.device).float()
+				tcr = tcr.to(self.device).long()
+				seq_len = seq_len.long()
 
 				if self.conditional is not None:
 					conditional = conditional.to(self.device)
@@ -430,12 +551,18 @@ class VAEBaseModel(ABC):
 
 	def save(self, filepath):
 		""" Save model and optimizer state, and auxiliary data for continuing training """
+		# the dict passed by the caller is left unchanged, it may be reused for other models, e.g. optuna trials
+		params_architecture = dict(self.params_architecture)
+		params_loader = dict(params_architecture['loader']) if 'loader' in params_architecture else {}
+		for key in LEARNED_LOADER_PARAMS:
+			params_loader[key] = self.params_loader[key]
+		params_architecture['loader'] = params_loader
 		model_file = {'state_dict': self.model.state_dict(),
 					  'train_history': self._train_history,
 					  'val_history': self._val_history,
 					  'aa_to_id': self.aa_to_id,
 
-					  'params_architecture': self.params_architecture,
+					  'params_architecture': params_architecture,
 					  'balanced_sampling': self.balanced_sampling,
 					  'metadata': self.metadata,
 					  'conditional': self.conditional,
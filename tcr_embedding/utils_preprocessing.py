@@ -1,6 +1,19 @@
+import os
 import numpy as np
-from tqdm import tqdm
-from sklearn.model_selection import GroupShuffleSplit
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+AA_TO_ID = {'_': 0, 'A': 1, 'C': 2, 'D': 3, 'E': 4, 'F': 5, 'G': 6, 'H': 7, 'I': 8, 'K': 9, 'L': 10, 'M': 11, 'N': 12,
+			'P': 13, 'Q': 14, 'R': 15, 'S': 16, 'T': 17, 'V': 18, 'W': 19, 'Y': 20, '+': 21, '<': 22, '>': 23}
+
+# candidate column names per field of the supported contig tables, the first one found in a table is used
+CONTIG_COLUMNS = {
+	'10x': {'barcode': ['barcode'], 'chain': ['chain'], 'cdr3': ['cdr3'], 'productive': ['productive'],
+			'umis': ['umis']},
+	'airr': {'barcode': ['cell_id'], 'chain': ['locus'], 'cdr3': ['junction_aa'], 'productive': ['productive'],
+			 'umis': ['umi_count', 'duplicate_count']},
+}
 
 
 def encode_tcr(adata, column_cdr3a, column_cdr3b, pad):
@@ -12,9 +25,7 @@ def encode_tcr(adata, column_cdr3a, column_cdr3b, pad):
 	:param pad: int, amount of position to pad the sequence to
 	:return: stores the numeric embedding to adata.obsm['alpha_seq'] and adata.obsm['beta_seq']
 	"""
-	aa_to_id = {'_': 0, 'A': 1, 'C': 2, 'D': 3, 'E': 4, 'F': 5, 'G': 6, 'H': 7, 'I': 8, 'K': 9, 'L': 10, 'M': 11,
-				'N': 12, 'P': 13, 'Q': 14, 'R': 15, 'S': 16, 'T': 17, 'V': 18, 'W': 19, 'Y': 20, '+': 21,
-				'<': 22, '>': 23}
+	aa_to_id = dict(AA_TO_ID)
 	adata.uns['aa_to_id'] = aa_to_id
 	aa_encoding(adata, read_col=column_cdr3b, label_col='beta_seq', length_col='beta_len', pad=pad, aa_to_id=aa_to_id,
 				start_end_symbol=False)
@@ -22,13 +33,44 @@ def encode_tcr(adata, column_cdr3a, column_cdr3b, pad):
 				start_end_symbol=False)
 
 
-def aa_encoding(adata, read_col, ohe_col=None, label_col=None, length_col=None, pad=False, aa_to_id=None, start_end_symbol=True):
+def get_token_dtype(num_values):
+	"""
+	Compact dtype for tokens and lengths, they are widened to int64 per batch in the model
+	:param num_values: int, number of different values, e.g. len(aa_to_id)
+	:return: np.dtype
+	"""
+	if num_values <= np.iinfo(np.uint8).max + 1:
+		return np.dtype(np.uint8)
+	return np.dtype(np.int64)
+
+
+def get_token_ids(sequences, width, aa_to_id):
 	"""
-	Encoding of protein or nucleotide sequence inplace, either one-hot-encoded or as index labels and/or one-hot-encoding
+	Token ids of sequences with the same length
+	:param sequences: list of str, all of length width
+	:param width: int, length of the sequences
+	:param aa_to_id: dict {aa: index}
+	:return: np.array int64 of shape [len(sequences), width]
+	"""
+	# fixed-width unicode view of the sequences, i.e. one code point per position, mapped by a lookup table
+	chars = np.array(sequences, dtype=f'U{max(width, 1)}').view(np.uint32).reshape(len(sequences), max(width, 1))
+	chars = chars[:, :width]
+	lookup = np.full(max(int(chars.max(initial=0)), max(ord(aa) for aa in aa_to_id)) + 1, -1, dtype=np.int64)
+	for aa, id_ in aa_to_id.items():
+		lookup[ord(aa)] = id_
+	token_ids = lookup[chars]
+	if (token_ids == -1).any():
+		unknown = sorted(set(chr(c) for c in chars[token_ids == -1]))
+		raise KeyError(f'Symbols {unknown} are missing in aa_to_id.')
+	return token_ids
+
+
+def aa_encoding(adata, read_col, label_col, length_col=None, pad=False, aa_to_id=None, start_end_symbol=True):
+	"""
+	Encoding of protein or nucleotide sequence inplace as index labels, the models one-hot-encode them on the fly
 	:param adata: adata file
 	:param read_col: str column containing sequence
-	:param ohe_col: None or str, if str column to write one-hot-encoded sequence into
-	:param label_col: None or str, if str then write labels as index to this column
+	:param label_col: str, write labels as index to this column
 	:param length_col: str column None or str, if str write sequence length into this column
 	:param pad: bool or int value, if int value then the sequence will be pad to this value,
 				if True then pad_len will be determined by taking the longest sequence length in adata
@@ -36,52 +78,155 @@ def aa_encoding(adata, read_col, ohe_col=None, label_col=None, length_col=None,
 	:param start_end_symbol: bool, add a start '<' and end '>' symbol to each sequence
 	:return:
 	"""
-	if label_col is None and ohe_col is None:
-		raise AssertionError('Specify at least one column to write: ohe_col or label_col')
-
 	if start_end_symbol:
 		adata.obs[read_col] = '<' + adata.obs[read_col].astype('str') + '>'
 		if type(pad) is not bool:
 			pad += 2
 
+	# each unique sequence is encoded once and broadcast to its cells, as clonotypes repeat many times
+	codes, sequences = pd.factorize(adata.obs[read_col])
+	if (codes == -1).any():
+		raise ValueError(f'adata.obs["{read_col}"] contains missing values.')
+	sequences = pd.Series(sequences, dtype=object)
+
+	lengths = sequences.str.len().to_numpy()
 	if length_col:
-		adata.obs[length_col] = adata.obs[read_col].str.len()
+		adata.obs[length_col] = lengths[codes].astype(get_token_dtype(lengths.max() + 1))
 
 	# Padding if specified
 	if type(pad) is not bool:
-		sequence_col = adata.obs[read_col].str.ljust(pad, '_')
+		sequences = sequences.str.ljust(pad, '_')
 	elif pad:
-		pad_len = adata.obs[read_col].str.len().max()
-		sequence_col = adata.obs[read_col].str.ljust(pad_len, '_')
-	else:
-		sequence_col = adata.obs[read_col]
-
-	# tokenize each character, i.e. create list of characters
-	aa_tokens = sequence_col.apply(lambda x: list(x))
+		sequences = sequences.str.ljust(lengths.max(), '_')
+	padded_lengths = sequences.str.len().to_numpy()
+	if (padded_lengths != padded_lengths[0]).any():
+		raise ValueError(f'The sequences in adata.obs["{read_col}"] have different lengths, please increase pad.')
+	width = int(padded_lengths[0])
 
 	# dict containing aa name as key and token-id as value
 	if aa_to_id is None:
-		unique_aa_tokens = sorted(set([x for sublist in aa_tokens for x in sublist]))
+		unique_aa_tokens = sorted(set(''.join(sequences)))
 		aa_to_id = {aa: id_ for id_, aa in enumerate(unique_aa_tokens)}
 
-	# convert aa to token_id (i.e. unique integer for each aa)
-	token_ids = [[aa_to_id[token] for token in aa_token] for aa_token in aa_tokens]
+	try:
+		token_ids = get_token_ids(sequences.tolist(), width, aa_to_id)
+	except KeyError as e:
+		raise KeyError(f'{e.args[0]} (adata.obs["{read_col}"])')
+
+	# write labels as index sequence
+	adata.obsm[label_col] = token_ids.astype(get_token_dtype(len(aa_to_id)))[codes]
+
+	adata.uns['aa_to_id'] = aa_to_id
+
+
+def get_contig_columns(path, table_format, sep):
+	"""
+	Columns to read from a contig table
+	:param path: str, path to the contig table
+	:param table_format: str, key of CONTIG_COLUMNS
+	:param sep: str, separator of the table
+	:return: dict {field: column name}
+	"""
+	header = pd.read_csv(path, sep=sep, nrows=0).columns
+	columns = {}
+	for field, candidates in CONTIG_COLUMNS[table_format].items():
+		found = [column for column in candidates if column in header]
+		if len(found) == 0:
+			raise ValueError(f'The contig table {path} has none of the columns {candidates}.')
+		columns[field] = found[0]
+	return columns
+
+
+def best_contigs(contigs):
+	"""
+	Per barcode and chain, the contig with the most UMIs, the first one wins on ties
+	:param contigs: pd.DataFrame with the columns barcode, chain, cdr3 and umis
+	:return: pd.DataFrame, at most one row per barcode and chain
+	"""
+	# stable, so the selections of several chunks can be combined in the order of the chunks
+	contigs = contigs.sort_values('umis', ascending=False, kind='stable')
+	return contigs.drop_duplicates(['barcode', 'chain'])
+
 
-	# convert token_ids to one-hot
-	if ohe_col is not None:
-		one_hot = [np.zeros((len(aa_token), len(aa_to_id))) for aa_token in aa_tokens]
-		for x_seq, token_id_seq in zip(one_hot, token_ids):
-			for x, token_id in zip(x_seq, token_id_seq):
-				x[token_id] = 1.0
-		# adata.obs[ohe_col] = one_hot
-		adata.obsm[ohe_col] = np.stack(one_hot)
+def select_chains(contigs, columns):
+	"""
+	Per barcode, the productive alpha and beta contig with the most UMIs
+	:param contigs: pd.DataFrame, chunk of a contig table
+	:param columns: dict {field: column name}, see get_contig_columns
+	:return: pd.DataFrame with the columns barcode, chain, cdr3 and umis, see best_contigs
+	"""
+	contigs = contigs.rename(columns={column: field for field, column in columns.items()})
+	productive = contigs['productive'].astype(str).str.upper().isin(['TRUE', 'T'])
+	selected = productive & contigs['chain'].isin(['TRA', 'TRB']) & contigs['cdr3'].notna()
+	return best_contigs(contigs.loc[selected, ['barcode', 'chain', 'cdr3', 'umis']])
 
-	# If specified write label as index sequence
-	if label_col is not None:
-		token_ids = [np.array(token_id) for token_id in token_ids]
-		# adata.obs[label_col] = token_ids
-		adata.obsm[label_col] = np.stack(token_ids)
 
+def encode_sequences(sequences, pad, aa_to_id):
+	"""
+	Token ids and lengths of sequences, padded with '_'
+	:param sequences: array of str
+	:param pad: int, amount of positions to pad the sequences to
+	:param aa_to_id: dict {aa: index}
+	:return: (np.array, np.array), token ids of shape [len(sequences), pad] and lengths
+	"""
+	sequences = pd.Series(sequences, dtype=object)
+	lengths = sequences.str.len().to_numpy(dtype=np.int64)
+	if lengths.max(initial=0) > pad:
+		raise ValueError(f'There are CDR3 sequences with {lengths.max()} amino acids, please increase pad.')
+	token_ids = get_token_ids(sequences.str.ljust(pad, '_').tolist(), pad, aa_to_id)
+	return token_ids.astype(get_token_dtype(len(aa_to_id))), lengths
+
+
+def ingest_contigs(adata, path, pad, table_format='10x', barcode_col=None, chunk_size=500000, num_workers=None,
+				   column_cdr3a='IR_VJ_1_junction_aa', column_cdr3b='IR_VDJ_1_junction_aa'):
+	"""
+	Reads a 10x contig annotation or AIRR rearrangement table in chunks, selects the productive alpha and beta CDR3 with
+	the most UMIs per cell and encodes them in a process pool. Writes the same outputs as encode_tcr, cells without an
+	alpha or beta chain get NaN in the CDR3 column and an empty sequence of length 0.
+	:param adata: adata, the contigs are matched to its cells
+	:param path: str, path to the contig table, e.g. filtered_contig_annotations.csv or an AIRR .tsv
+	:param pad: int, amount of positions to pad the sequences to
+	:param table_format: str, '10x' or 'airr'
+	:param barcode_col: None or str, column of adata.obs holding the barcodes of the contig table, by default obs_names
+	:param chunk_size: int, number of contigs read at once
+	:param num_workers: None or int, number of processes, by default the number of cores
+	:param column_cdr3a: str, column of adata.obs to write the selected CDR3 alpha into
+	:param column_cdr3b: str, column of adata.obs to write the selected CDR3 beta into
+	:return: stores the selected CDR3s to adata.obs and their encoding as with encode_tcr
+	"""
+	if table_format not in CONTIG_COLUMNS:
+		raise ValueError(f'Unknown table format {table_format}, please use one of {list(CONTIG_COLUMNS)}.')
+	sep = '\t' if path.endswith(('.tsv', '.tsv.gz')) else ','
+	columns = get_contig_columns(path, table_format, sep)
+	num_workers = num_workers or os.cpu_count()
+	barcodes = adata.obs_names if barcode_col is None else adata.obs[barcode_col].astype(str)
+	aa_to_id = dict(AA_TO_ID)
+
+	reader = pd.read_csv(path, sep=sep, usecols=list(columns.values()), chunksize=chunk_size,
+						 dtype={columns['barcode']: str, columns['chain']: str, columns['cdr3']: str})
+	with ProcessPoolExecutor(num_workers) as pool:
+		# only a few chunks are in flight, so the memory does not grow with the size of the table
+		pending, selected = [], []
+		for chunk in reader:
+			pending.append(pool.submit(select_chains, chunk, columns))
+			if len(pending) > 2 * num_workers:
+				selected.append(pending.pop(0).result())
+		selected += [future.result() for future in pending]
+		chains = best_contigs(pd.concat(selected))
+
+		for chain, column, label_col, length_col in [('TRB', column_cdr3b, 'beta_seq', 'beta_len'),
+													 ('TRA', column_cdr3a, 'alpha_seq', 'alpha_len')]:
+			cdr3 = chains.loc[chains['chain'] == chain].set_index('barcode')['cdr3'].reindex(barcodes).to_numpy()
+			codes, sequences = pd.factorize(cdr3)
+			parts = np.array_split(np.asarray(sequences, dtype=object), num_workers)
+			encoded = list(pool.map(encode_sequences, parts, [pad] * len(parts), [aa_to_id] * len(parts)))
+			# the last row is the empty sequence, it is selected by the code -1 of missing chains
+			token_ids = np.concatenate([part[0] for part in encoded] + [np.zeros((1, pad), encoded[0][0].dtype)])
+			lengths = np.concatenate([part[1] for part in encoded] + [[0]])
+
+			adata.obs[column] = cdr3
+			adata.obsm[label_col] = token_ids[codes]
+			adata.obs[length_col] = lengths[codes].astype(get_token_dtype(pad + 1))
 	adata.uns['aa_to_id'] = aa_to_id
 
 
@@ -103,46 +248,91 @@ def stratified_group_shuffle_split(df, stratify_col, group_col, val_split, rando
 	:param df: pd.DataFrame containing the data to split
 	:param stratify_col: str key for the column containing the classes to be stratified over all sets
 	:param group_col: str key for the column containing the groups to be kept in the same set
+	:param val_split: float, fraction of the groups per label that go to the test set
+	:param random_seed: int, seed for the shuffling of the groups of each label
+	:return: (np.array, np.array), integer positions of the train and test rows in df
 	"""
-	groups = df.groupby(stratify_col)
-	all_train = []
-	all_test = []
-	for group_id, group in tqdm(groups):
+	group_codes, _ = pd.factorize(df[group_col], sort=True)
+	label_codes, _ = pd.factorize(df[stratify_col], sort=True)
+	# -1: not assigned yet, 0: train, 1: test
+	assignment = np.full(group_codes.max(initial=0) + 1, -1, dtype=np.int8)
+
+	order = np.argsort(label_codes, kind='stable')
+	bounds = np.searchsorted(label_codes[order], np.arange(label_codes.max(initial=-1) + 2))
+	for start, end in zip(bounds[:-1], bounds[1:]):
+		codes = group_codes[order[start:end]]
 		# if a group is already taken in test or train it must stay there
-		group = group[~group[group_col].isin(all_train + all_test)]
-		# if group is empty
-		if group.shape[0] == 0:
+		codes = codes[(codes != -1) & (assignment[np.maximum(codes, 0)] == -1)]
+		groups = np.unique(codes)
+		# if there is only one clonotype for this particular label
+		if len(groups) <= 1:
+			assignment[groups] = 0
 			continue
+		# same shuffling as GroupShuffleSplit with n_splits=1
+		n_test, n_train = get_split_sizes(len(groups), val_split)
+		permutation = np.random.RandomState(random_seed).permutation(len(groups))
+		assignment[groups[permutation[:n_test]]] = 1
+		assignment[groups[permutation[n_test:n_test + n_train]]] = 0
 
-		if len(group) > 1:
-			train_inds, test_inds = next(
-				GroupShuffleSplit(test_size=val_split, n_splits=1, random_state=random_seed).split(group, groups=group[
-					group_col]))
-			all_train += group.iloc[train_inds][group_col].tolist()
-			all_test += group.iloc[test_inds][group_col].tolist()
-		# if there is only one clonotype for this particular label
-		else:
-			all_train += group[group_col].tolist()
+	cell_assignment = np.where(group_codes != -1, assignment[np.maximum(group_codes, 0)], -1)
+	train = np.flatnonzero(cell_assignment == 0)
+	test = np.flatnonzero(cell_assignment == 1)
+	return train, test
 
-	train = df[df[group_col].isin(all_train)]
-	test = df[df[group_col].isin(all_test)]
 
-	return train, test
+def get_split_sizes(n_groups, val_split):
+	"""
+	Number of test and train groups, as in sklearn's ShuffleSplit
+	:param n_groups: int, number of groups to split
+	:param val_split: float, fraction of the groups in the test set
+	:return: (int, int), number of test and train groups
+	"""
+	n_test = int(np.ceil(val_split * n_groups))
+	n_train = int(np.floor((1 - val_split) * n_groups))
+	return n_test, n_train
+
+
+def group_shuffle_splits(groups, val_split, random_seeds, n_candidates=5):
+	"""
+	Group shuffle splits for several seeds at once, e.g. for a sweep over splits. Per seed, n_candidates splits are
+	drawn as with GroupShuffleSplit and the one with the val fraction closest to val_split is kept.
+	:param groups: array-like, group of each cell, e.g. adata.obs['clonotype']
+	:param val_split: float, fraction of the groups in the val set
+	:param random_seeds: list of int, one split per seed
+	:param n_candidates: int, number of candidate splits per seed
+	:return: list of (np.array, np.array), integer positions of the train and val cells per seed
+	"""
+	group_codes, _ = pd.factorize(np.asarray(groups), sort=True)
+	if (group_codes == -1).any():
+		raise ValueError('The group column contains missing values.')
+	n_groups = group_codes.max(initial=-1) + 1
+	group_sizes = np.bincount(group_codes, minlength=n_groups)
+	n_test, n_train = get_split_sizes(n_groups, val_split)
+
+	splits = []
+	for random_seed in random_seeds:
+		rng = np.random.RandomState(random_seed)
+		permutations = np.stack([rng.permutation(n_groups) for _ in range(n_candidates)])
+		val_sizes = group_sizes[permutations[:, :n_test]].sum(axis=1)
+		# the first candidate wins on ties
+		best = np.argmin(np.abs(val_sizes / len(group_codes) - val_split))
+
+		# 1: val, 0: train, -1: in neither set, as the rounding of the set sizes can leave out a group
+		assignment = np.full(n_groups, -1, dtype=np.int8)
+		assignment[permutations[best, :n_test]] = 1
+		assignment[permutations[best, n_test:n_test + n_train]] = 0
+		cell_assignment = assignment[group_codes]
+		splits.append((np.flatnonzero(cell_assignment == 0), np.flatnonzero(cell_assignment == 1)))
+	return splits
 
 
 def group_shuffle_split(adata_tmp, group_col, val_split, random_seed=42):
-	groups = adata_tmp.obs[group_col]
-	splitter = GroupShuffleSplit(test_size=val_split, n_splits=5, random_state=random_seed)
-
-	best_value = 1
-	train, val = None, None
-	for train_tmp, val_tmp in splitter.split(adata_tmp, groups=groups):
-		split_value = abs(len(val_tmp) / len(adata_tmp) - val_split)
-		if split_value < best_value:
-			train = train_tmp
-			val = val_tmp
-			best_value = split_value
-
-	train = adata_tmp[train]
-	val = adata_tmp[val]
-	return train, val
+	"""
+	Split the cells into train and val, so that each group is only in one set
+	:param adata_tmp: adata
+	:param group_col: str, column of adata.obs containing the groups, e.g. clonotype
+	:param val_split: float, fraction of the groups in the val set
+	:param random_seed: int, seed of the split
+	:return: (np.array, np.array), integer positions of the train and val cells, adata_tmp is not copied
+	"""
+	return group_shuffle_splits(adata_tmp.obs[group_col], val_split, [random_seed])[0]
@@ -12,6 +12,7 @@ from tcr_embedding.models.mixture_modules.rna_model import RnaModel
 from tcr_embedding.models.mixture_modules.separate_model import SeparateModel
 from tcr_embedding.models.mixture_modules.poe import PoEModel
 from tcr_embedding.models.mixture_modules.moe import MoEModel
+from tcr_embedding.dataloader.Collection import AnnDataCollection
 
 
 def fix_seeds(random_seed=42):
@@ -20,10 +21,11 @@ def fix_seeds(random_seed=42):
     random.seed(random_seed)
 
 
-def load_data(source='10x'):
+def load_data(source='10x', backed=None):
     """
     Loads the whole dataset from a defined source.
     :param source: str indicting the dataset or filename starting from the data_folder
+    :param backed: None or 'r', if 'r' adata.X stays on disk and only the rows of each batch are read during training
     :return: adata object
     """
     path_current = os.path.dirname(__file__)
@@ -53,7 +55,7 @@ def load_data(source='10x'):
     path_file = os.path.join(path_base, path_source)
 
     try:
-        data = sc.read_h5ad(path_file)
+        data = sc.read_h5ad(path_file, backed=backed)
     except FileNotFoundError:
         raise FileNotFoundError(f'Data file not found at {path_file}. '
                                 f'Please specify data source by "10x", "bcc", "scc", "haniffa", or "covid". '
@@ -61,7 +63,28 @@ def load_data(source='10x'):
     return data
 
 
+def load_collection(sources, keys=None, backed='r', cohort_key='cohort'):
+    """
+    Loads several datasets as one collection without concatenating them, e.g. to train on multiple cohorts
+    :param sources: list of str, sources or filenames as for load_data
+    :param keys: None or list of str, name of each cohort, by default the sources
+    :param backed: None or 'r', see load_data
+    :param cohort_key: str, column of collection.obs holding the cohort of each cell, e.g. used as conditional
+    :return: AnnDataCollection
+    """
+    adatas = [load_data(source, backed=backed) for source in sources]
+    keys = sources if keys is None else keys
+    return AnnDataCollection(adatas, keys, cohort_key)
+
+
 def load_model(adata, path_model, base_path=None):
+    """
+    Loads a trained model
+    :param adata: adata or path of a bundle written by export_bundle, with the data the model is used on
+    :param path_model: str, path to the model file, relative to the repository or base_path
+    :param base_path: None or str, base path of path_model
+    :return: model
+    """
     if base_path is None:
         base_path = os.path.dirname(__file__)
         path_model = os.path.join(base_path, '..', path_model)